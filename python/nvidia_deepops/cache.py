@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017, NVIDIA CORPORATION. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of NVIDIA CORPORATION nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from . import utils
+
+
+__all__ = ('ResponseCache',)
+
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+
+class ResponseCache:
+    """
+    Persistent cache of decoded JSON responses keyed by request URL.
+
+    Each entry keeps the `ETag` and `Last-Modified` validators returned by the
+    server so that a stale entry can be revalidated with a conditional request;
+    a `304 Not Modified` answer then costs no payload at all.  Entries younger
+    than `max_age` seconds are served without contacting the server.
+
+    :param str path: directory holding one JSON file per entry
+    :param int max_size: upper bound in bytes on the total size of all
+        entries; the least recently stored entries are evicted first
+    :param int ttl: entries not refreshed within `ttl` seconds are evicted
+    :param int max_age: entries refreshed within `max_age` seconds are
+        considered fresh and are not revalidated
+    """
+
+    def __init__(self, path, *, max_size=256 * 1024 * 1024,
+                 ttl=7 * 24 * 60 * 60, max_age=0):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._index = {}
+        os.makedirs(path, exist_ok=True)
+        for entry in os.scandir(path):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                self._index[entry.name] = (stat.st_size, stat.st_mtime)
+        with self._lock:
+            self._evict()
+
+    def _filename(self, url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json"
+
+    def get(self, url):
+        """
+        Returns the entry for `url` or None.  Entries are dicts with `data`,
+        `etag`, `last_modified` and `stored` keys.
+        """
+        name = self._filename(url)
+        with self._lock:
+            if name not in self._index:
+                return None
+            _, stored = self._index[name]
+            if time.time() - stored > self.ttl:
+                self._remove(name)
+                return None
+        try:
+            with open(os.path.join(self.path, name), "rb") as file:
+                entry = json.load(file)
+        except (OSError, ValueError) as err:
+            log.warning("discarding unreadable cache entry for {}: {}".format(
+                url, err))
+            with self._lock:
+                self._remove(name)
+            return None
+        entry["stored"] = stored
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["stored"] < self.max_age
+
+    @staticmethod
+    def validators(entry):
+        """
+        Returns the conditional request headers used to revalidate `entry`.
+        """
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, url, data, *, etag=None, last_modified=None):
+        name = self._filename(url)
+        payload = json.dumps({
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "data": data,
+        }).encode("utf-8")
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(payload)
+        os.replace(tmp, os.path.join(self.path, name))
+        with self._lock:
+            self._index[name] = (len(payload), time.time())
+            self._evict()
+
+    def touch(self, url):
+        """
+        Marks the entry for `url` as freshly validated, e.g. after a 304.
+        """
+        name = self._filename(url)
+        now = time.time()
+        with self._lock:
+            if name not in self._index:
+                return
+            try:
+                os.utime(os.path.join(self.path, name), (now, now))
+            except OSError:
+                self._remove(name)
+                return
+            self._index[name] = (self._index[name][0], now)
+
+    def _remove(self, name):
+        self._index.pop(name, None)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        now = time.time()
+        for name, (_, stored) in list(self._index.items()):
+            if now - stored > self.ttl:
+                self._remove(name)
+        total = sum(size for size, _ in self._index.values())
+        if total <= self.max_size:
+            return
+        for name, (size, _) in sorted(self._index.items(),
+                                      key=lambda kv: kv[1][1]):
+            self._remove(name)
+            total -= size
+            if total <= self.max_size:
+                break
@@ -27,17 +27,197 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import abc
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
 
 
-__all__ = ('BaseClient',)
+__all__ = ('BaseClient', 'url2filename')
 
 ABC = abc.ABCMeta('ABC', (object,), {})  # compatible with Python 2 *and* 3
 
+DEFAULT_CHUNK_SIZE = 2 * 1024 * 1024
+
+COMPRESSION_SUFFIXES = {
+    None: '.tar',
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+}
+
+
+def tar_suffix(filename):
+    """Returns the tarfile suffix of `filename`, longest match first."""
+    for suffix in sorted(COMPRESSION_SUFFIXES.values(), key=len, reverse=True):
+        if filename.endswith(suffix):
+            return suffix
+    return ''
+
+
+def url2filename(url, compression=None):
+    """
+    Returns the filename under which image `url` is saved, with the tarfile
+    suffix of `compression`.
+    """
+    suffix = COMPRESSION_SUFFIXES[compression]
+    return 'docker_image_{}{}'.format(url, suffix).replace('/', '%%')
+
+
+def compressor_command(compression, level=None, threads=0):
+    """
+    Returns the argv of a multi-threaded compressor writing `compression`
+    ('gzip' or 'zstd') from stdin to stdout.
+
+    gzip uses `pigz` when it is installed and falls back to single-threaded
+    `gzip`.
+    :param int level: compression level; the tool's default when None
+    :param int threads: worker threads; 0 uses every core
+    """
+    if compression == 'zstd':
+        command = ['zstd', '-q', '-c', '-T{}'.format(threads)]
+    elif compression == 'gzip':
+        if shutil.which('pigz'):
+            command = ['pigz', '-c']
+            if threads:
+                command.extend(['-p', str(threads)])
+        else:
+            command = ['gzip', '-c']
+    else:
+        raise ValueError("unsupported compression {}".format(compression))
+    if level is not None:
+        command.append('-{}'.format(level))
+    return command
+
+
+def compress_stream(chunks, command, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Pipes an iterable of byte chunks through the compressor `command` and
+    yields its output in chunks of at most `chunk_size` bytes.  The input is
+    fed from a helper thread so that neither side of the pipe can block the
+    other.
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+            yield chunk
+    finally:
+        process.stdout.close()
+        feeder.join()
+        returncode = process.wait()
+    if errors:
+        raise errors[0]
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def decompress_stream(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields the contents of `filename` in chunks of at most `chunk_size` bytes,
+    decompressing `.tar.zst` files, which the docker daemon cannot load
+    directly.
+    """
+    if tar_suffix(filename) != COMPRESSION_SUFFIXES['zstd']:
+        yield from read_stream(filename, chunk_size)
+        return
+    command = ['zstd', '-q', '-d', '-c', filename]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+            yield chunk
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def write_stream(chunks, filename):
+    """
+    Writes an iterable of byte chunks to `filename` without holding more than
+    one chunk in memory and returns the hex SHA-256 of the data.
+
+    The data is written to a temporary file that replaces `filename` once
+    complete, and the digest is recorded next to it in `<filename>.sha256` in
+    the format read by `sha256sum -c`.
+    """
+    sha256 = hashlib.sha256()
+    partial = filename + '.part'
+    try:
+        with open(partial, 'wb') as file:
+            for chunk in chunks:
+                sha256.update(chunk)
+                file.write(chunk)
+        os.replace(partial, filename)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    digest = sha256.hexdigest()
+    with open(filename + '.sha256', 'w') as file:
+        file.write('{}  {}\n'.format(digest, os.path.basename(filename)))
+    return digest
+
+
+def read_stream(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields the contents of `filename` in chunks of at most `chunk_size` bytes.
+    """
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            yield chunk
+
+
+def follow_pull(events, progress=None):
+    """
+    Consumes the decoded event stream of a daemon pull and reports the layer
+    bytes downloaded since the previous event to `progress(nbytes)`.
+
+    Layers are tracked by id: "Downloading" events carry the bytes done so far
+    in `progressDetail`, and "Download complete" finishes the layer.  An error
+    event raises RuntimeError.
+    """
+    layers = {}
+    for event in events:
+        if 'error' in event:
+            raise RuntimeError(event['error'])
+        detail = event.get('progressDetail') or {}
+        status = event.get('status')
+        layer = event.get('id')
+        done, total = layers.get(layer, (0, 0))
+        if status == 'Downloading' and detail.get('total'):
+            total = detail['total']
+            current = min(detail.get('current', 0), total)
+        elif status == 'Download complete' and total:
+            current = total
+        else:
+            continue
+        layers[layer] = (max(done, current), total)
+        if current > done and progress is not None:
+            progress(current - done)
+
 
 class BaseClient(ABC):
 
     @abc.abstractmethod
-    def pull(self, url):
+    def pull(self, url, progress=None):
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -52,3 +232,10 @@ class BaseClient(ABC):
     def remove(self, url):
         raise NotImplementedError()
 
+    def image_size(self, url):
+        """
+        Returns the size in bytes of image `url` in the daemon, which bounds
+        its saved tarfile, or None if the image is not there.
+        """
+        image = self.get(url=url)
+        return image.attrs.get('Size') if image is not None else None
@@ -28,6 +28,7 @@
 
 import logging
 import os
+import re
 import shlex
 import subprocess
 import sys
@@ -35,7 +36,9 @@ import sys
 import docker
 
 from nvidia_deepops import utils
-from nvidia_deepops.docker.client.base import BaseClient
+from nvidia_deepops.docker.client.base import (
+    BaseClient, COMPRESSION_SUFFIXES, DEFAULT_CHUNK_SIZE, compress_stream,
+    compressor_command, follow_pull, tar_suffix, url2filename, write_stream)
 
 __all__ = ('DockerClient',)
 
@@ -43,9 +46,24 @@ log = utils.get_logger(__name__, level=logging.INFO)
 
 
 class DockerClient(BaseClient):
-
-    def __init__(self):
+    """
+    Docker client driving the `docker` command line.
+
+    :param int chunk_size: bytes held in memory at a time while saving image
+        tarfiles
+    :param str compression: 'gzip' or 'zstd' to compress saved tarfiles
+    :param int compression_level: compressor level; the tool's default when
+        None
+    :param int compression_threads: compressor threads; 0 uses every core
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, compression=None,
+                 compression_level=None, compression_threads=0):
         self.client = docker.from_env(timeout=600)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
 
     def call(self, command, stdout=None, stderr=None, quiet=False):
         stdout = stdout or sys.stderr
@@ -69,8 +87,19 @@ class DockerClient(BaseClient):
         except docker.errors.ImageNotFound:
             return None
 
-    def pull(self, url):
-        self.call("docker pull %s" % url)
+    def pull(self, url, progress=None):
+        """
+        Pulls `url` with `docker pull`, or through the daemon API when
+        `progress(nbytes)` is given, so that it can be fed the bytes of each
+        layer as they download.
+        """
+        if progress is None:
+            self.call("docker pull %s" % url)
+            return url
+        log.debug("docker pull %s" % url)
+        repository, tag = docker.utils.parse_repository_tag(url)
+        follow_pull(self.client.api.pull(repository, tag=tag, stream=True,
+                                         decode=True), progress)
         return url
 
     def push(self, url):
@@ -86,17 +115,42 @@ class DockerClient(BaseClient):
         return url
 
     def url2filename(self, url):
-        return "docker_image_{}.tar".format(url).replace("/", "%%")
+        return url2filename(url, self.compression)
 
     def filename2url(self, filename):
-        return os.path.basename(filename).replace("docker_image_", "")\
-            .replace(".tar", "").replace("%%", "/")
-
-    def save(self, url, path=None):
+        basename = os.path.basename(filename)
+        basename = basename[:len(basename) - len(tar_suffix(basename))]
+        return basename.replace("docker_image_", "").replace("%%", "/")
+
+    def save(self, url, path=None, progress=None):
+        """
+        Saves image `url` to a tarfile in `path` and returns its filename.
+        `progress(nbytes)` is called for every chunk read from the daemon.
+        """
         filename = self.url2filename(url)
         if path:
             filename = os.path.join(path, filename)
-        self.call("docker save -o {} {}".format(filename, url))
+        command = "docker save {}".format(url)
+        log.debug(command)
+        process = subprocess.Popen(shlex.split(command),
+                                   stdout=subprocess.PIPE)
+        try:
+            chunks = iter(lambda: process.stdout.read(self.chunk_size), b"")
+            if progress:
+                chunks = utils.counted(chunks, progress)
+            if self.compression:
+                chunks = compress_stream(chunks, compressor_command(
+                    self.compression, level=self.compression_level,
+                    threads=self.compression_threads), self.chunk_size)
+            digest = write_stream(chunks, filename)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode:
+            os.remove(filename)
+            os.remove(filename + ".sha256")
+            raise subprocess.CalledProcessError(returncode, command)
+        log.debug("saved {} (sha256:{})".format(filename, digest))
         return filename
 
     def image_exists(self, url):
@@ -111,7 +165,28 @@ class DockerClient(BaseClient):
         basename = os.path.basename(filename)
         if expected_url is None and not basename.startswith("docker_image_"):
             raise RuntimeError("Invalid filename")
-        self.call("docker load -i %s" % filename)
+        if tar_suffix(filename) == COMPRESSION_SUFFIXES["zstd"]:
+            # docker load understands gzip but not zstd
+            log.debug("zstd -dc %s | docker load" % filename)
+            process = subprocess.Popen(["zstd", "-q", "-d", "-c", filename],
+                                       stdout=subprocess.PIPE)
+            try:
+                output = subprocess.check_output(["docker", "load"],
+                                                 stdin=process.stdout)
+            finally:
+                process.stdout.close()
+                process.wait()
+        else:
+            log.debug("docker load -i %s" % filename)
+            output = subprocess.check_output(
+                ["docker", "load", "-i", filename])
+        output = output.decode("utf-8", "replace")
+        sys.stderr.write(output)
+        loaded = re.findall(r"^Loaded image: (\S+)$", output, re.MULTILINE)
+        if loaded and url not in loaded and not self.image_exists(url):
+            # tarfiles linked for a re-tagged image still carry the original
+            # tag
+            self.tag(loaded[0], url)
         if not self.image_exists(url):
             log.error("expected url from %s is %s" % (filename, url))
             raise RuntimeError("Image {} not found".format(url))
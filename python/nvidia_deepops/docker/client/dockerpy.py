@@ -32,7 +32,9 @@ import os
 import docker
 
 from nvidia_deepops import utils
-from nvidia_deepops.docker.client.base import BaseClient
+from nvidia_deepops.docker.client.base import (
+    BaseClient, DEFAULT_CHUNK_SIZE, compress_stream, compressor_command,
+    decompress_stream, follow_pull, tar_suffix, url2filename, write_stream)
 
 
 __all__ = ('DockerPy',)
@@ -42,9 +44,24 @@ log = utils.get_logger(__name__, level=logging.INFO)
 
 
 class DockerPy(BaseClient):
-
-    def __init__(self):
+    """
+    Docker client backed by the docker SDK.
+
+    :param int chunk_size: bytes held in memory at a time while saving or
+        loading image tarfiles
+    :param str compression: 'gzip' or 'zstd' to compress saved tarfiles
+    :param int compression_level: compressor level; the tool's default when
+        None
+    :param int compression_threads: compressor threads; 0 uses every core
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, compression=None,
+                 compression_level=None, compression_threads=0):
         self.client = docker.from_env(timeout=600)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
 
     def login(self, *, username, password, registry):
         self.client.login(username=username,
@@ -56,9 +73,18 @@ class DockerPy(BaseClient):
         except docker.errors.ImageNotFound:
             return None
 
-    def pull(self, url):
+    def pull(self, url, progress=None):
+        """
+        Pulls `url`, feeding `progress(nbytes)`, if given, the bytes of each
+        layer as they download.
+        """
         log.debug("docker pull %s" % url)
-        self.client.images.pull(url)
+        if progress is None:
+            self.client.images.pull(url)
+            return
+        repository, tag = docker.utils.parse_repository_tag(url)
+        follow_pull(self.client.api.pull(repository, tag=tag, stream=True,
+                                         decode=True), progress)
 
     def push(self, url):
         log.debug("docker push %s" % url)
@@ -74,28 +100,48 @@ class DockerPy(BaseClient):
         self.client.images.remove(url)
 
     def url2filename(self, url):
-        return "docker_image_{}.tar".format(url).replace("/", "%%")
+        return url2filename(url, self.compression)
 
     def filename2url(self, filename):
-        return os.path.basename(filename).replace("docker_image_", "")\
-            .replace(".tar", "").replace("%%", "/")
-
-    def save(self, url, path=None):
+        basename = os.path.basename(filename)
+        basename = basename[:len(basename) - len(tar_suffix(basename))]
+        return basename.replace("docker_image_", "").replace("%%", "/")
+
+    def save(self, url, path=None, progress=None):
+        """
+        Saves image `url` to a tarfile in `path` and returns its filename.
+        `progress(nbytes)` is called for every chunk read from the daemon.
+        """
         filename = self.url2filename(url)
         if path:
             filename = os.path.join(path, filename)
         log.debug("saving %s --> %s" % (url, filename))
-        image = self.client.api.get_image(url)
-        with open(filename, "wb") as tarfile:
-            tarfile.write(image.data)
+        try:
+            chunks = self.client.api.get_image(url,
+                                               chunk_size=self.chunk_size)
+        except TypeError:
+            # docker-py < 3.0 has no chunk_size and returns the raw response
+            chunks = self.client.api.get_image(url).stream(self.chunk_size)
+        if progress:
+            chunks = utils.counted(chunks, progress)
+        if self.compression:
+            chunks = compress_stream(chunks, compressor_command(
+                self.compression, level=self.compression_level,
+                threads=self.compression_threads), self.chunk_size)
+        digest = write_stream(chunks, filename)
+        log.debug("saved %s (sha256:%s)" % (filename, digest))
         return filename
 
     def load(self, filename):
         log.debug("loading image from %s" % filename)
-        with open(filename, "rb") as file:
-            self.client.images.load(file)
+        images = self.client.images.load(
+            decompress_stream(filename, self.chunk_size))
         basename = os.path.basename(filename)
         if basename.startswith("docker_image_"):
             url = self.filename2url(filename)
             log.debug("expected url from %s is %s" % (filename, url))
+            if images and url not in images[0].tags:
+                # tarfiles linked for a re-tagged image still carry the
+                # original tag
+                images[0].tag(url)
             return url
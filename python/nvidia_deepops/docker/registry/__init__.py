@@ -26,7 +26,11 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from .auth import *
 from .base import *
+from .catalog import *
+from .copier import *
+from .ocilayout import *
 from .dockregistry import *
 from .dgxregistry import *
 from .ngcregistry import *
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017, NVIDIA CORPORATION. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of NVIDIA CORPORATION nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import base64
+import json
+import logging
+import threading
+import time
+
+from nvidia_deepops import utils
+
+
+__all__ = ('TokenManager', 'token_lifetime')
+
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+
+def token_lifetime(token, data=None, default=300):
+    """
+    Returns the lifetime of a bearer token in seconds.
+
+    Uses the `expires_in` field of the token response when present, otherwise
+    the `exp` claim of the token when it is a JWT, otherwise `default`.
+    """
+    data = data or {}
+    if data.get("expires_in"):
+        return float(data["expires_in"])
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode("utf-8")))
+        return float(claims["exp"]) - time.time()
+    except Exception:
+        return default
+
+
+class TokenManager:
+    """
+    Thread-safe cache of a single bearer token.
+
+    `fetch` is called without arguments and must return a `(token, lifetime)`
+    tuple.  The token is refreshed once less than `refresh_margin` seconds (at
+    most a quarter of its lifetime) remain, so callers never present an
+    expired token.  Concurrent callers share one in-flight refresh; while it
+    runs, callers holding a still-valid token keep using it.  With
+    `background=True` the refresh is scheduled on a daemon timer ahead of
+    expiry so that no request has to wait for it.
+    """
+
+    def __init__(self, fetch, *, refresh_margin=60, background=False):
+        self._fetch = fetch
+        self._refresh_margin = refresh_margin
+        self._background = background
+        self._cond = threading.Condition()
+        self._token = None
+        self._expires_at = 0
+        self._refresh_at = 0
+        self._refreshing = False
+        self._timer = None
+
+    def get(self):
+        """
+        Returns a valid token, refreshing it first if necessary.
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._token and now < self._refresh_at:
+                    return self._token
+                if self._token and now < self._expires_at and self._refreshing:
+                    return self._token
+                if not self._refreshing:
+                    self._refreshing = True
+                    break
+                self._cond.wait()
+        return self._refresh()
+
+    def invalidate(self, token=None):
+        """
+        Forgets the current token.  When `token` is given, the current token
+        is only forgotten if it is the one that was rejected, so that many
+        callers failing with the same stale token trigger a single refresh.
+        """
+        with self._cond:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = self._refresh_at = 0
+
+    def close(self):
+        with self._cond:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _refresh(self):
+        try:
+            token, lifetime = self._fetch()
+        except Exception:
+            with self._cond:
+                self._refreshing = False
+                self._cond.notify_all()
+            raise
+        now = time.time()
+        with self._cond:
+            self._token = token
+            self._expires_at = now + lifetime
+            self._refresh_at = self._expires_at - min(self._refresh_margin,
+                                                      lifetime / 4.0)
+            self._refreshing = False
+            self._cond.notify_all()
+            if self._background:
+                self._schedule(self._refresh_at - now)
+        return token
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 0),
+                                      self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        with self._cond:
+            self._timer = None
+            if self._refreshing:
+                return
+            self._refreshing = True
+        try:
+            self._refresh()
+            log.debug("bearer token refreshed ahead of expiry")
+        except Exception as err:
+            log.warning("background token refresh failed with {}".format(err))
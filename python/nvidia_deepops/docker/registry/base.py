@@ -28,6 +28,10 @@
 
 import abc
 
+from concurrent import futures
+
+from nvidia_deepops.docker.registry.catalog import CatalogSnapshot
+
 
 __all__ = ('BaseRegistry',)
 
@@ -46,7 +50,8 @@ class BaseRegistry(ABC):
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def get_state(self, project=None, filter_fn=None):
+    def get_state(self, project=None, filter_fn=None, max_workers=None,
+                  name_filter_fn=None, catalog=None, resolve_digests=False):
         """
         Returns a unique hash for each image and tag with the ability to filter
         on the project/prefix.
@@ -56,6 +61,15 @@ class BaseRegistry(ABC):
         :param filter_fn: Callable function that takes (name, tag, docker_id)
             kwargs and returns true/false. Ff the image should be included in
             the returned set.
+        :param int max_workers: optional upper bound on the number of
+            concurrent per-image tag requests; serial when None or 1
+        :param name_filter_fn: Callable function that takes a `name` kwarg and
+            returns true/false if the image should be considered at all.
+            Images rejected here are skipped before their tags are listed.
+        :param catalog: optional `CatalogSnapshot` shared with other queries
+            of the same run so that each endpoint is fetched at most once
+        :param bool resolve_digests: identify each tag by its manifest digest
+            where the registry API reports something else, e.g. a date
         :return: dict of dicts
             {
                 "image_name_A": {
@@ -67,6 +81,49 @@ class BaseRegistry(ABC):
         """
         raise NotImplementedError()
 
+    def snapshot(self, fingerprints=None):
+        """
+        Returns a new `CatalogSnapshot` of this registry.  Share it between
+        the queries of a single run and discard it afterwards.
+
+        :param dict fingerprints: `CatalogSnapshot.fingerprints()` of the
+            previous run, so that unchanged repositories are not listed again
+        """
+        return CatalogSnapshot(self, fingerprints=fingerprints)
+
+    def repo_fingerprint(self, repo):
+        """
+        Returns a value that changes whenever a tag of the repository record
+        `repo` of `_get_repo_data` changes, or None when the record carries no
+        such metadata and the tags must always be listed.
+        """
+        return None
+
+    def filter_image_names(self, names, name_filter_fn=None):
+        """
+        Returns the subset of `names` accepted by `name_filter_fn`.  This is
+        the name-level half of the `get_state` filters and lets registries
+        skip tag listings for images that can never match.
+        """
+        if name_filter_fn is None or not callable(name_filter_fn):
+            return list(names)
+        return [name for name in names if name_filter_fn(name=name)]
+
+    def _map_images(self, fn, names, max_workers=None):
+        """
+        Calls `fn(name)` for each image name and returns a list of
+        `(name, result)` tuples in the same order as `names`.  When
+        `max_workers` is greater than 1, the calls are fanned out over a
+        bounded thread pool as `names` is consumed, so `names` may be a
+        generator that is still paging through a catalog; the first exception
+        raised by `fn` is re-raised.
+        """
+        if not max_workers or max_workers <= 1:
+            return [(name, fn(name)) for name in names]
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = [(name, executor.submit(fn, name)) for name in names]
+            return [(name, future.result()) for name, future in pending]
+
     def docker_url(self, name, tag):
         return "{}/{}:{}".format(self.url, name, tag)
 
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017, NVIDIA CORPORATION. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of NVIDIA CORPORATION nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import threading
+
+from nvidia_deepops import utils
+
+
+__all__ = ('CatalogSnapshot',)
+
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+
+class CatalogSnapshot:
+    """
+    Memoized view of a registry catalog shared by everything that queries the
+    registry during a single replication run.
+
+    The repository listing and the per-image tag data are each fetched at most
+    once; `get_state`, `get_image_names`, `get_image_descriptions` and
+    `get_image_tags` all read from the snapshot via their `cache=` arguments.
+    The wrapped registry must implement `_get_repo_data` and `_get_image_data`.
+    Thread-safe, so it may be shared by a concurrent `get_state`.
+
+    Across runs, the snapshot reuses the tag data of repositories whose
+    fingerprint in the repository listing is unchanged, see
+    `BaseRegistry.repo_fingerprint`: it is read with
+    `_get_image_data(image_name, revalidate=False)`, which registries that
+    provide fingerprints serve from their response cache, and the digests
+    resolved for its tags are reused.
+
+    :param dict fingerprints: the result of `fingerprints()` of a previous run
+    """
+
+    def __init__(self, registry, fingerprints=None):
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._repositories = None
+        self._by_name = {}
+        self._images = {}
+        self._previous = dict(fingerprints or {})
+        self._records = {}
+
+    def repositories(self, project=None):
+        """
+        Returns the repository records of `project`, or of every project when
+        `project` is None.
+        """
+        with self._lock:
+            if self._repositories is None:
+                self._repositories = self.registry._get_repo_data()
+                self._by_name = {repo["image_name"]: repo
+                                 for repo in self._repositories}
+        return [repo for repo in self._repositories
+                if not project or repo["namespace"] == project]
+
+    def fingerprint(self, image_name):
+        """
+        Returns the fingerprint of `image_name` in the repository listing, or
+        None when the registry does not provide one.
+        """
+        self.repositories()
+        repo = self._by_name.get(image_name)
+        if repo is None:
+            return None
+        return self.registry.repo_fingerprint(repo)
+
+    def changed(self, project=None):
+        """
+        Returns the names of the repositories of `project` that are new or
+        whose fingerprint differs from the previous run.  Repositories without
+        a fingerprint only count as changed when they are new; changes to
+        their tags are found by the next complete run.
+        """
+        names = set()
+        for repo in self.repositories(project):
+            fingerprint = self.registry.repo_fingerprint(repo)
+            previous = self._previous.get(repo["image_name"])
+            if previous is None or (
+                    fingerprint is not None and
+                    previous.get("fingerprint") != fingerprint):
+                names.add(repo["image_name"])
+        return names
+
+    def image_data(self, image_name):
+        """
+        Returns the tag records of `image_name`.
+        """
+        with self._lock:
+            if image_name in self._images:
+                return self._images[image_name]
+        fingerprint = self.fingerprint(image_name)
+        previous = self._previous.get(image_name) or {}
+        if fingerprint is not None and \
+                previous.get("fingerprint") == fingerprint:
+            log.debug("%s unchanged since the last run", image_name)
+            data = self.registry._get_image_data(image_name, revalidate=False)
+        else:
+            data = self.registry._get_image_data(image_name)
+        with self._lock:
+            data = self._images.setdefault(image_name, data)
+            self._record(image_name)["fingerprint"] = fingerprint
+            return data
+
+    def _record(self, image_name):
+        # callers hold the lock
+        if image_name not in self._records:
+            previous = self._previous.get(image_name) or {}
+            self._records[image_name] = {
+                "fingerprint": previous.get("fingerprint"),
+                "digests": dict(previous.get("digests") or {}),
+            }
+        return self._records[image_name]
+
+    def digest(self, image_name, tag, version):
+        """
+        Returns the digest recorded for `image_name:tag` when the tag was at
+        `version`, e.g. its update date, or None.
+        """
+        with self._lock:
+            record = self._records.get(image_name) or \
+                self._previous.get(image_name) or {}
+            cached = (record.get("digests") or {}).get(tag)
+        if cached and cached[0] == version:
+            return cached[1]
+        return None
+
+    def record_digest(self, image_name, tag, version, digest):
+        with self._lock:
+            self._record(image_name)["digests"][tag] = [version, digest]
+
+    def fingerprints(self):
+        """
+        Returns the per-repository fingerprints and tag digests to pass to
+        the snapshot of the next run.  Repositories that were not queried in
+        this run keep their previous record.
+        """
+        with self._lock:
+            records = dict(self._previous)
+            records.update(self._records)
+            if self._repositories is not None:
+                records = {name: record for name, record in records.items()
+                           if name in self._by_name}
+            # the tag listings stay in the registry's response cache
+            return {name: {"fingerprint": record.get("fingerprint"),
+                           "digests": record.get("digests") or {}}
+                    for name, record in records.items()}
+
+    def image_names(self, project=None):
+        return self.registry.get_image_names(
+            project=project, cache=self.repositories(project))
+
+    def image_descriptions(self, project=None):
+        return self.registry.get_image_descriptions(
+            project=project, cache=self.repositories(project))
+
+    def image_tags(self, image_name):
+        return self.registry.get_image_tags(
+            image_name, cache=self.image_data(image_name))
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017, NVIDIA CORPORATION. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of NVIDIA CORPORATION nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import logging
+import threading
+
+from concurrent import futures
+
+from nvidia_deepops import utils
+from nvidia_deepops.docker.registry.dockregistry import RegistryError
+
+
+__all__ = ('ImageCopier',)
+
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+
+INDEX_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+)
+
+FOREIGN_LAYER_MEDIA_TYPES = (
+    'application/vnd.docker.image.rootfs.foreign.diff.tar.gzip',
+    'application/vnd.oci.image.layer.nondistributable.v1.tar+gzip',
+)
+
+
+class ImageCopier:
+    """
+    Copies images from one v2 registry to another over HTTP, without a Docker
+    daemon.
+
+    Manifests are copied byte for byte so digests are preserved.  Blobs are
+    streamed from `source` to `target` in `chunk_size` pieces and never touch
+    the local disk; blobs the target repository already holds are skipped, and
+    blobs already copied to another repository of the target during the
+    lifetime of the copier are cross-mounted instead of re-uploaded.  Up to
+    `max_workers` blobs of an image are transferred concurrently.
+
+    :param DockerRegistry source: registry to read from, e.g. nvcr.io
+    :param DockerRegistry target: registry to write to
+    """
+
+    def __init__(self, source, target, *, max_workers=4,
+                 chunk_size=1024 * 1024):
+        self.source = source
+        self.target = target
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._copied = {}
+
+    def copy(self, name, tag, target_name=None, target_tag=None, source=None,
+             progress=None):
+        """
+        Copies `name:tag` of the source to `target_name:target_tag` of the
+        target, which default to the same name and tag; returns the digest
+        of the copied manifest as stored by the target.  `source` overrides
+        the source registry for this image only.  `progress(nbytes)` is called
+        for every chunk of a blob that is transferred and once for every blob
+        that is skipped.
+        """
+        source = source or self.source
+        target_name = target_name or name
+        target_tag = target_tag or tag
+        content, media_type, digest = source.get_raw_manifest(name, tag)
+        log.info("copying {}:{} ({}) --> {}/{}:{}".format(
+            name, tag, digest, self.target.url, target_name, target_tag))
+        return self._copy_manifest(source, name, target_name, content,
+                                   media_type, reference=target_tag,
+                                   progress=progress) or digest
+
+    def _copy_manifest(self, source, name, target_name, content, media_type,
+                       reference, progress=None):
+        manifest = json.loads(content.decode('utf-8'))
+        if media_type in INDEX_MEDIA_TYPES:
+            # child manifests must exist on the target before the index
+            for child in manifest.get('manifests', []):
+                child_content, child_type, _ = source.get_raw_manifest(
+                    name, child['digest'])
+                self._copy_manifest(source, name, target_name, child_content,
+                                    child.get('mediaType') or child_type,
+                                    reference=child['digest'],
+                                    progress=progress)
+        elif 'layers' in manifest:
+            blobs = [manifest['config']] + [
+                layer for layer in manifest['layers']
+                if layer.get('mediaType') not in FOREIGN_LAYER_MEDIA_TYPES]
+            self._copy_blobs(source, name, target_name, blobs, progress)
+        else:
+            raise RegistryError(
+                "unsupported manifest type {} for {}".format(media_type, name))
+        return self.target.put_manifest(target_name, reference, content,
+                                        media_type)
+
+    def _copy_blobs(self, source, name, target_name, blobs, progress=None):
+        def copy_blob(blob):
+            return self._copy_blob(source, name, target_name, blob['digest'],
+                                   blob.get('size'), progress)
+
+        if self.max_workers <= 1:
+            for blob in blobs:
+                copy_blob(blob)
+            return
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+            for _ in ex.map(copy_blob, blobs):
+                pass
+
+    def _copy_blob(self, source, name, target_name, digest, size=None,
+                   progress=None):
+        if self.target.blob_exists(target_name, digest):
+            log.debug("%s already present in %s", digest, target_name)
+            if progress and size:
+                progress(size)
+            return
+        with self._lock:
+            mount_from = self._copied.get(digest)
+        if mount_from and self.target.mount_blob(target_name, digest,
+                                                 mount_from):
+            log.debug("%s mounted from %s", digest, mount_from)
+            if progress and size:
+                progress(size)
+            return
+        r = source.get_blob(name, digest)
+        try:
+            chunks = r.iter_content(self.chunk_size)
+            if progress:
+                chunks = utils.counted(chunks, progress)
+            self.target.upload_blob(target_name, digest, chunks)
+        finally:
+            r.close()
+        with self._lock:
+            self._copied[digest] = target_name
@@ -31,10 +31,11 @@ import base64
 import logging
 
 import contexttimer
-import requests
 
 from nvidia_deepops import utils
+from nvidia_deepops.session import Session
 from nvidia_deepops.docker.registry.base import BaseRegistry
+from nvidia_deepops.docker.registry.dockregistry import DockerRegistry
 
 
 log = utils.get_logger(__name__, level=logging.INFO)
@@ -47,7 +48,7 @@ __all__ = ('DGXRegistry',)
 class DGXRegistry(BaseRegistry):
 
     def __init__(self, api_key, nvcr_url='nvcr.io',
-                 nvcr_api_url=None):
+                 nvcr_api_url=None, session=None, cache=None):
         self.api_key = api_key
         self.api_key_b64 = base64.b64encode(api_key.encode("utf-8"))\
             .decode("utf-8")
@@ -55,20 +56,41 @@ class DGXRegistry(BaseRegistry):
         nvcr_api_url = 'https://compute.nvidia.com' if nvcr_api_url is None \
             else nvcr_api_url
         self._nvcr_api_url = nvcr_api_url
+        self._session = session or Session()
+        self._cache = cache
+        self.v2 = DockerRegistry(url=nvcr_url, username='$oauthtoken',
+                                 password=api_key, verify_ssl=True,
+                                 session=self._session)
 
     def _get(self, endpoint):
-        dev.debug("GET %s" % self._api_url(endpoint))
+        url = self._api_url(endpoint)
+        cached = self._cache.get(url) if self._cache else None
+        if cached is not None and self._cache.is_fresh(cached):
+            dev.debug("CACHED %s", url)
+            return cached["data"]
+
+        dev.debug("GET %s", url)
+        headers = {
+            'Authorization': 'APIKey {}'.format(self.api_key_b64),
+            'Accept': 'application/json',
+        }
+        if cached is not None:
+            headers.update(self._cache.validators(cached))
         with contexttimer.Timer() as timer:
-            req = requests.get(self._api_url(endpoint), headers={
-                'Authorization': 'APIKey {}'.format(self.api_key_b64),
-                'Accept': 'application/json',
-            })
-        log.info("GET {} - took {} sec".format(self._api_url(endpoint),
-                                               timer.elapsed))
+            req = self._session.get(url, headers=headers)
+        log.info("GET {} - took {} sec".format(url, timer.elapsed))
+
+        if req.status_code == 304 and cached is not None:
+            dev.debug("NOT MODIFIED %s", url)
+            self._cache.touch(url)
+            return cached["data"]
+
         req.raise_for_status()
         data = req.json()
-        # dev.debug("GOT {}: {}".format(self._api_url(endpoint),
-        #                               pprint.pformat(data, indent=4)))
+        dev.debug("GOT %s: %s", url, utils.lazy_pformat(data))
+        if self._cache:
+            self._cache.put(url, data, etag=req.headers.get("ETag"),
+                            last_modified=req.headers.get("Last-Modified"))
         return data
 
     def _api_url(self, endpoint):
@@ -112,12 +134,15 @@ class DGXRegistry(BaseRegistry):
             "nvidia/*" images
         :return: ["nvidia/caffe", "nvidia/cuda", ...]
         """
-        return [image["image_name"]
-                for image in cache or self._get_repo_data(project=project)]
+        if cache is None:
+            cache = self._get_repo_data(project=project)
+        return [image["image_name"] for image in cache]
 
     def get_image_descriptions(self, project=None, cache=None):
+        if cache is None:
+            cache = self._get_repo_data(project=project)
         return {image['image_name']: image.get("description", "")
-                for image in cache or self._get_repo_data(project=project)}
+                for image in cache}
 
     def get_image_tags(self, image_name, cache=None):
         """
@@ -127,8 +152,9 @@ class DGXRegistry(BaseRegistry):
             `nvidia/caffe`
         :return: list of tag strings: ['17.07', '17.06', ... ]
         """
-        return [tag['name']
-                for tag in cache or self._get_image_data(image_name)]
+        if cache is None:
+            cache = self._get_image_data(image_name)
+        return [tag['name'] for tag in cache]
 
     def _get_image_data(self, image_name):
         """
@@ -148,11 +174,21 @@ class DGXRegistry(BaseRegistry):
         endpoint = "/".join(["repository", image_name])
         return self._get(endpoint)['tags']
 
-    def get_state(self, project=None, filter_fn=None):
-        names = self.get_image_names(project=project)
+    def get_state(self, project=None, filter_fn=None, max_workers=None,
+                  name_filter_fn=None, catalog=None, resolve_digests=False):
+        """
+        See `BaseRegistry.get_state`.  The `docker_id` of each tag is its
+        content-addressed `dockerImageId`, so `resolve_digests` is accepted
+        for compatibility with `NGCRegistry` but not needed.
+        """
+        if catalog is None:
+            catalog = self.snapshot()
+        names = self.filter_image_names(catalog.image_names(project=project),
+                                        name_filter_fn)
         state = collections.defaultdict(dict)
-        for name in names:
-            for tag in self._get_image_data(name):
+        for name, tags in self._map_images(catalog.image_data, names,
+                                           max_workers=max_workers):
+            for tag in tags:
                 if filter_fn is not None and callable(filter_fn):
                     if not filter_fn(name=name, tag=tag["name"],
                                      docker_id=tag["dockerImageId"]):
@@ -160,5 +196,6 @@ class DGXRegistry(BaseRegistry):
                 state[name][tag["name"]] = {
                     "docker_id": tag["dockerImageId"],
                     "registry": "nvcr.io",
+                    "size": tag.get("size"),
                 }
         return state
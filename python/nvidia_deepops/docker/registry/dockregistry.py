@@ -26,23 +26,38 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import collections
+import functools
 import pprint
 import logging
+import re
+import threading
+
+from urllib.parse import urlencode, urlsplit
 
 import contexttimer
-import requests
 from requests.auth import AuthBase, HTTPBasicAuth
 
 from nvidia_deepops import utils
+from nvidia_deepops.session import Session
+from nvidia_deepops.docker.registry.auth import TokenManager, token_lifetime
 from nvidia_deepops.docker.registry.base import BaseRegistry
 
 
-__all__ = ('DockerRegistry',)
+__all__ = ('DockerRegistry', 'RegistryError')
 
 
 log = utils.get_logger(__name__, level=logging.INFO)
 
 
+MANIFEST_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+)
+
+
 class RegistryError(Exception):
     def __init__(self, message, code=None, detail=None):
         super(RegistryError, self).__init__(message)
@@ -78,7 +93,8 @@ class BearerAuth(AuthBase):
 
 class DockerRegistry(BaseRegistry):
 
-    def __init__(self, *, url, username=None, password=None, verify_ssl=False):
+    def __init__(self, *, url, username=None, password=None, verify_ssl=False,
+                 session=None, page_size=100):
         url = url.rstrip('/')
         if not (url.startswith('http://') or url.startswith('https://')):
             url = 'https://' + url
@@ -87,70 +103,323 @@ class DockerRegistry(BaseRegistry):
         self.username = username
         self.password = password
         self.verify_ssl = verify_ssl
+        self.page_size = page_size
         self.auth = None
+        self._session = session or Session()
+        self._challenge = None
+        self._tokens = {}
+        self._tokens_lock = threading.Lock()
 
     def authenticate(self):
         """
         Forcefully auth for testing
         """
-        r = requests.head(self.url + '/v2/', verify=self.verify_ssl)
+        r = self._session.head(self.url + '/v2/', verify=self.verify_ssl)
         self._authenticate_for(r)
 
-    def _authenticate_for(self, resp):
+    @staticmethod
+    def _scope(endpoint, method='GET'):
         """
-        Authenticate to satsify the unauthorized response
+        Returns the token scope required by a `method` `/v2/<endpoint>` request
         """
-        # Get the auth. info from the headers
-        scheme, params = resp.headers['Www-Authenticate'].split(None, 1)
-        assert (scheme == 'Bearer')
-        info = {k: v.strip('"') for k, v in (i.split('=')
-                                             for i in params.split(','))}
-
-        # Request a token from the auth server
-        params = {k: v for k, v in info.items() if k in ('service', 'scope')}
-        auth = HTTPBasicAuth(self.username, self.password)
-        r2 = requests.get(info['realm'], params=params,
-                          auth=auth, verify=self.verify_ssl)
+        if endpoint.startswith('_catalog'):
+            return 'registry:catalog:*'
+        actions = 'pull' if method in ('GET', 'HEAD') else 'pull,push'
+        for marker in ('/tags/', '/manifests/', '/blobs/'):
+            if marker in endpoint:
+                name = endpoint.split(marker)[0]
+                return 'repository:{}:{}'.format(name, actions)
+        return None
+
+    def _token_manager(self, scope):
+        with self._tokens_lock:
+            if scope not in self._tokens:
+                self._tokens[scope] = TokenManager(
+                    functools.partial(self._request_token, scope))
+            return self._tokens[scope]
+
+    def _request_token(self, scope):
+        """
+        Request a token for `scope` from the auth server of the last challenge
+        """
+        service = self._challenge.get('service')
+        params = {k: v for k, v in (('service', service), ('scope', scope))
+                  if v}
+        auth = None
+        if self.username is not None:
+            auth = HTTPBasicAuth(self.username, self.password)
+        r2 = self._session.get(self._challenge['realm'], params=params,
+                               auth=auth, verify=self.verify_ssl)
 
         if r2.status_code == 401:
             raise RuntimeError("Authentication Error")
         r2.raise_for_status()
 
-        self.auth = BearerAuth(r2.json()['token'])
+        data = r2.json()
+        token = data.get('token') or data.get('access_token')
+        return token, token_lifetime(token, data)
 
-    def _get(self, endpoint):
-        url = '{0}/v2/{1}'.format(self.url, endpoint)
-        log.debug("GET {}".format(url))
+    def _auth(self, endpoint, method='GET'):
+        """
+        Returns the cached bearer auth for the scope of `endpoint`, so that
+        requests carry a valid token up front instead of collecting a 401
+        """
+        scope = self._scope(endpoint, method)
+        if self._challenge is None or scope is None:
+            return self.auth
+        return BearerAuth(self._token_manager(scope).get())
+
+    def _authenticate_for(self, resp, rejected=None):
+        """
+        Authenticate to satsify the unauthorized response
+        """
+        # Get the auth. info from the headers
+        scheme, params = resp.headers['Www-Authenticate'].split(None, 1)
+        assert (scheme == 'Bearer')
+        info = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        self._challenge = {k: v for k, v in info.items()
+                           if k in ('realm', 'service')}
+
+        # Request a token from the auth server, unless another thread has
+        # already replaced the rejected one
+        tokens = self._token_manager(info.get('scope'))
+        tokens.invalidate(rejected.token if rejected is not None else None)
+        self.auth = BearerAuth(tokens.get())
+        return self.auth
+
+    def _url(self, endpoint):
+        return '{0}/v2/{1}'.format(self.url, endpoint)
+
+    @staticmethod
+    def _endpoint(location):
+        """
+        Converts a URL or absolute path returned by the registry, e.g. in a
+        `Link` or `Location` header, into an endpoint relative to `/v2/`
+        """
+        parts = urlsplit(location)
+        path = parts.path.split('/v2/', 1)[-1]
+        return path + ('?' + parts.query if parts.query else '')
+
+    def _request(self, method, endpoint, **kwargs):
+        """
+        Issues `method` against `/v2/<endpoint>` and returns the response;
+        authenticates and retries once if the request is unauthorized.  A
+        streamed body cannot be sent twice, so an unauthorized request with
+        one raises `RegistryError` after authenticating instead
+        """
+        url = self._url(endpoint)
+        log.debug("%s %s", method, url)
 
         # Try to use previous bearer token
+        auth = self._auth(endpoint, method)
         with contexttimer.Timer() as timer:
-            r = requests.get(url, auth=self.auth, verify=self.verify_ssl)
+            r = self._session.request(method, url, auth=auth,
+                                      verify=self.verify_ssl, **kwargs)
 
-        log.info("GET {} - took {} sec".format(url, timer.elapsed))
+        log.info("{} {} - took {} sec".format(method, url, timer.elapsed))
 
         # If necessary, try to authenticate and try again
         if r.status_code == 401:
-            self._authenticate_for(r)
-            r = requests.get(url, auth=self.auth, verify=self.verify_ssl)
+            auth = self._authenticate_for(r, rejected=auth)
+            if not isinstance(kwargs.get('data'),
+                              (type(None), bytes, bytearray, str, dict)):
+                # the chunks were consumed by the rejected request
+                r.close()
+                raise RegistryError(
+                    "{} {} was unauthorized".format(method, url), code=401)
+            r = self._session.request(method, url, auth=auth,
+                                      verify=self.verify_ssl, **kwargs)
+        return r
 
+    def _get(self, endpoint):
+        return self._json(self._request('GET', endpoint))
+
+    def _json(self, r):
         data = r.json()
 
         if r.status_code != 200:
             raise RegistryError.from_data(data)
 
-        log.debug("GOT {}: {}".format(url, pprint.pformat(data, indent=4)))
+        log.debug("GOT %s: %s", r.url, utils.lazy_pformat(data))
         return data
 
-    def get_image_names(self, project=None):
-        data = self._get('_catalog')
-        return [image for image in data['repositories']]
-
-    def get_image_tags(self, image_name):
+    def _iter_pages(self, endpoint, key, page_size=None):
+        """
+        Yields the entries under `key` of a paginated listing page by page,
+        following the `Link: <...>; rel="next"` header of the v2 API
+        """
+        page_size = page_size or self.page_size
+        endpoint = '{}?{}'.format(endpoint, urlencode({'n': page_size}))
+        while endpoint:
+            r = self._request('GET', endpoint)
+            for item in self._json(r).get(key) or []:
+                yield item
+            endpoint = None
+            link = r.links.get('next', {}).get('url')
+            if link:
+                endpoint = self._endpoint(link)
+
+    def iter_image_names(self, project=None, page_size=None):
+        """
+        Streams the repository names of the catalog, optionally filtered on
+        the `project/` prefix, one page at a time
+        """
+        for name in self._iter_pages('_catalog', 'repositories',
+                                     page_size=page_size):
+            if project and not name.startswith(project + '/'):
+                continue
+            yield name
+
+    def get_image_names(self, project=None, cache=None):
+        if cache is not None:
+            return [repo["image_name"] for repo in cache]
+        return list(self.iter_image_names(project=project))
+
+    def get_image_tags(self, image_name, cache=None):
+        if cache is not None:
+            return cache
         endpoint = '{name}/tags/list'.format(name=image_name)
-        return self._get(endpoint)['tags']
+        return list(self._iter_pages(endpoint, 'tags'))
+
+    def _get_repo_data(self):
+        """
+        Returns a record for each repository of the catalog, as read by
+        `CatalogSnapshot`
+        """
+        return [{"image_name": name,
+                 "namespace": name.split('/')[0] if '/' in name else ''}
+                for name in self.iter_image_names()]
+
+    def _get_image_data(self, image_name):
+        return self.get_image_tags(image_name)
+
+    def get_digest(self, name, reference):
+        """
+        Returns the content digest of the manifest of `name:reference` using a
+        HEAD request, so no manifest body is transferred
+        """
+        r = self._request(
+            'HEAD', '{name}/manifests/{reference}'.format(name=name,
+                                                          reference=reference),
+            headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)})
+        if r.status_code != 200:
+            raise RegistryError("HEAD {}:{} failed".format(name, reference),
+                                code=r.status_code)
+        return r.headers.get('Docker-Content-Digest')
+
+    def get_raw_manifest(self, name, reference):
+        """
+        Returns the manifest of `name:reference` exactly as stored, together
+        with its media type and digest: `(content, media_type, digest)`
+        """
+        r = self._request(
+            'GET', '{name}/manifests/{reference}'.format(name=name,
+                                                         reference=reference),
+            headers={'Accept': ', '.join(MANIFEST_MEDIA_TYPES)})
+        if r.status_code != 200:
+            raise RegistryError.from_data(r.json())
+        media_type = r.headers.get('Content-Type', '').split(';')[0]
+        return r.content, media_type, r.headers.get('Docker-Content-Digest')
+
+    def put_manifest(self, name, reference, content, media_type):
+        r = self._request(
+            'PUT', '{name}/manifests/{reference}'.format(name=name,
+                                                         reference=reference),
+            data=content, headers={'Content-Type': media_type})
+        if r.status_code not in (200, 201):
+            raise RegistryError.from_data(r.json())
+        return r.headers.get('Docker-Content-Digest')
+
+    def blob_exists(self, name, digest):
+        r = self._request('HEAD', '{name}/blobs/{digest}'.format(
+            name=name, digest=digest))
+        return r.status_code == 200
+
+    def get_blob(self, name, digest):
+        """
+        Returns the streaming response for blob `digest`; iterate over
+        `iter_content()` and close it when done
+        """
+        r = self._request('GET', '{name}/blobs/{digest}'.format(
+            name=name, digest=digest), stream=True)
+        if r.status_code != 200:
+            data = r.json()
+            r.close()
+            raise RegistryError.from_data(data)
+        return r
+
+    def mount_blob(self, name, digest, from_name):
+        """
+        Asks the registry to link blob `digest` of repository `from_name` into
+        `name` without transferring it; returns True if it was mounted
+        """
+        r = self._request('POST', '{name}/blobs/uploads/?{query}'.format(
+            name=name, query=urlencode({'mount': digest, 'from': from_name})))
+        if r.status_code == 202:
+            self._cancel_upload(r)
+        return r.status_code == 201
+
+    def upload_blob(self, name, digest, data):
+        """
+        Uploads blob `digest` to repository `name` in a single request;
+        `data` may be bytes or an iterable of byte chunks, which is streamed
+        """
+        r = self._request('POST', '{name}/blobs/uploads/'.format(name=name))
+        if r.status_code != 202:
+            raise RegistryError.from_data(r.json())
+        location = self._endpoint(r.headers['Location'])
+        separator = '&' if '?' in location else '?'
+        r = self._request('PUT', location + separator +
+                          urlencode({'digest': digest}), data=data,
+                          headers={'Content-Type': 'application/octet-stream'})
+        if r.status_code != 201:
+            raise RegistryError.from_data(r.json())
+        return r.headers.get('Docker-Content-Digest', digest)
+
+    def _cancel_upload(self, r):
+        try:
+            self._request('DELETE', self._endpoint(r.headers['Location']))
+        except Exception:
+            pass
 
     def get_manifest(self, name, reference):
         data = self._get(
             '{name}/manifests/{reference}'.format(name=name,
                                                   reference=reference))
         pprint.pprint(data)
+
+    def get_state(self, project=None, filter_fn=None, max_workers=None,
+                  name_filter_fn=None, catalog=None, resolve_digests=False):
+        """
+        See `BaseRegistry.get_state`.  Tags are always identified by their
+        manifest digest, so `resolve_digests` is accepted for compatibility
+        with `NGCRegistry` but ignored.  Without a `catalog` snapshot, the
+        catalog is streamed page by page and tag listing for each repository
+        starts while later pages are still being read.
+        """
+        if catalog is not None:
+            names = self.filter_image_names(
+                catalog.image_names(project=project), name_filter_fn)
+            image_tags = catalog.image_tags
+        else:
+            names = (name for name in self.iter_image_names(project=project)
+                     if name_filter_fn is None or name_filter_fn(name=name))
+            image_tags = self.get_image_tags
+
+        def repo_state(name):
+            return {tag: self.get_digest(name, tag)
+                    for tag in image_tags(name) or []}
+
+        state = collections.defaultdict(dict)
+        registry = urlsplit(self.url).netloc
+        for name, tags in self._map_images(repo_state, names,
+                                           max_workers=max_workers):
+            for tag, digest in tags.items():
+                if filter_fn is not None and callable(filter_fn):
+                    if not filter_fn(name=name, tag=tag, docker_id=digest):
+                        continue
+                state[name][tag] = {
+                    "docker_id": digest,
+                    "registry": registry,
+                }
+        return state
@@ -29,13 +29,15 @@
 import collections
 import base64
 import logging
-import pprint
+import threading
 
 import contexttimer
-import requests
 
 from nvidia_deepops import utils
+from nvidia_deepops.session import Session
+from nvidia_deepops.docker.registry.auth import TokenManager, token_lifetime
 from nvidia_deepops.docker.registry.base import BaseRegistry
+from nvidia_deepops.docker.registry.dockregistry import DockerRegistry
 
 
 log = utils.get_logger(__name__, level=logging.INFO)
@@ -49,7 +51,7 @@ class NGCRegistry(BaseRegistry):
 
     def __init__(self, api_key, nvcr_url='nvcr.io',
                  nvcr_api_url=None,
-                 ngc_auth_url=None):
+                 ngc_auth_url=None, session=None, cache=None):
         self.api_key = api_key
         self.api_key_b64 = base64.b64encode(
             api_key.encode("utf-8")).decode("utf-8")
@@ -61,24 +63,25 @@ class NGCRegistry(BaseRegistry):
         ngc_auth_url = 'https://authn.nvidia.com' if ngc_auth_url is None \
             else ngc_auth_url
         self._ngc_auth_url = ngc_auth_url
-
-        self._token = None
-        self.orgs = None
-        self.default_org = None
-        self._authenticate_for(None)
-
-    def _authenticate_for(self, resp):
+        self._session = session or Session()
+        self._cache = cache
+        self.v2 = DockerRegistry(url=nvcr_url, username='$oauthtoken',
+                                 password=api_key, verify_ssl=True,
+                                 session=self._session)
+
+        self._tokens = TokenManager(self._request_token, background=True)
+        # the bearer token and the org list are requested on first use, so that
+        # constructing a registry costs no request
+        self._orgs_lock = threading.RLock()
+        self._orgs = None
+        self._default_org = None
+
+    def _request_token(self):
         """
-        Authenticate to satsify the unauthorized response
+        Requests a new bearer token from the auth server; returns the token and
+        its lifetime in seconds
         """
-        # Invalidate current bearer token
-        self._token = None
-
-        # Future-proofing the API so the response from the failed request could
-        # be evaluated here
-
-        # Request a token from the auth server
-        req = requests.get(
+        req = self._session.get(
             url="{}/token?scope=group/ngc".format(self._ngc_auth_url),
             headers={
                 'Authorization': 'ApiKey {}'.format(self.api_key_b64),
@@ -89,55 +92,105 @@ class NGCRegistry(BaseRegistry):
         # Raise error on failed request
         req.raise_for_status()
 
-        # Set new Bearer Token
-        self._token = req.json()['token']
+        data = req.json()
+        return data['token'], token_lifetime(data['token'], data)
+
+    def _authenticate_for(self, resp):
+        """
+        Authenticate to satsify the unauthorized response
+        """
+        # Invalidate the bearer token rejected by the failed request; if
+        # another thread already replaced it, the new token is reused
+        if resp is not None:
+            rejected = resp.request.headers.get('Authorization', '')
+            self._tokens.invalidate(rejected[len('Bearer '):])
+        else:
+            self._tokens.invalidate()
+
+        # Request a token from the auth server
+        self._tokens.get()
 
+    @property
+    def orgs(self):
         # Unfortunately NGC requests require an org-name, even for requests
         # where the org-name is extra/un-needed information.
         # To handle this condition, we will get the list of orgs the user
         # belongs to
-        if not self.orgs:
-            log.debug("no org list - fetching that now")
-            data = self._get("orgs")
-            self.orgs = data['organizations']
-            self.default_org = self.orgs[0]['name']
-            log.debug("default_org: {}".format(self.default_org))
+        with self._orgs_lock:
+            if not self._orgs:
+                log.debug("no org list - fetching that now")
+                data = self._get("orgs")
+                self._orgs = data['organizations']
+            return self._orgs
+
+    @property
+    def default_org(self):
+        with self._orgs_lock:
+            if self._default_org is None:
+                self._default_org = self.orgs[0]['name']
+                log.debug("default_org: %s", self._default_org)
+            return self._default_org
+
+    @default_org.setter
+    def default_org(self, org):
+        with self._orgs_lock:
+            self._default_org = org
 
     @property
     def token(self):
-        if not self._token:
-            self._authenticate_for(None)
-        if not self._token:
+        token = self._tokens.get()
+        if not token:
             raise RuntimeError(
                 "NGC Bearer token is not set; this is unexpected")
-        return self._token
+        return token
+
+    def _headers(self, cached=None):
+        headers = {
+            'Authorization': 'Bearer {}'.format(self.token),
+            'Accept': 'application/json',
+        }
+        if cached is not None:
+            headers.update(self._cache.validators(cached))
+        return headers
+
+    def _get(self, endpoint, revalidate=True):
+        """
+        GETs `endpoint` of the NGC API through the response cache.  With
+        `revalidate=False`, a cached response is returned without contacting
+        the server, e.g. for listings known to be unchanged.
+        """
+        url = self._api_url(endpoint)
+        cached = self._cache.get(url) if self._cache else None
+        if cached is not None and (not revalidate or
+                                   self._cache.is_fresh(cached)):
+            dev.debug("CACHED %s", url)
+            return cached["data"]
 
-    def _get(self, endpoint):
-        dev.debug("GET %s" % self._api_url(endpoint))
+        dev.debug("GET %s", url)
 
         # try to user current bearer token; this could result in a 401 if the
         # token is expired
         with contexttimer.Timer() as timer:
-            req = requests.get(self._api_url(endpoint), headers={
-                'Authorization': 'Bearer {}'.format(self.token),
-                'Accept': 'application/json',
-            })
-        log.info("GET {} - took {} sec".format(self._api_url(endpoint),
-                                               timer.elapsed))
+            req = self._session.get(url, headers=self._headers(cached))
+        log.info("GET {} - took {} sec".format(url, timer.elapsed))
 
         if req.status_code == 401:
             # re-authenticate and repeat the request -  failure here is final
             self._authenticate_for(req)
-            req = requests.get(self._api_url(endpoint), headers={
-                'Authorization': 'Bearer {}'.format(self.token),
-                'Accept': 'application/json',
-            })
+            req = self._session.get(url, headers=self._headers(cached))
+
+        if req.status_code == 304 and cached is not None:
+            dev.debug("NOT MODIFIED %s", url)
+            self._cache.touch(url)
+            return cached["data"]
 
         req.raise_for_status()
 
         data = req.json()
-        dev.debug("GOT {}: {}".format(self._api_url(
-            endpoint), pprint.pformat(data, indent=4)))
+        dev.debug("GOT %s: %s", url, utils.lazy_pformat(data))
+        if self._cache:
+            self._cache.put(url, data, etag=req.headers.get("ETag"),
+                            last_modified=req.headers.get("Last-Modified"))
         return data
 
     def _api_url(self, endpoint):
@@ -200,12 +253,14 @@ class NGCRegistry(BaseRegistry):
             "nvidia/*" images
         :return: ["nvidia/caffe", "nvidia/cuda", ...]
         """
-        return [image["image_name"]
-                for image in cache or self._get_repo_data(project=project)]
+        if cache is None:
+            cache = self._get_repo_data(project=project)
+        return [image["image_name"] for image in cache]
 
     def get_image_descriptions(self, project=None, cache=None):
-        return {image['image_name']: image["description"]
-                for image in cache or self._get_repo_data(project=project)}
+        if cache is None:
+            cache = self._get_repo_data(project=project)
+        return {image['image_name']: image["description"] for image in cache}
 
     def get_image_tags(self, image_name, cache=None):
         """
@@ -215,13 +270,23 @@ class NGCRegistry(BaseRegistry):
             `nvidia/caffe`
         :return: list of tag strings: ['17.07', '17.06', ... ]
         """
-        return [image['tag']
-                for image in cache or self._get_image_data(image_name)]
+        if cache is None:
+            cache = self._get_image_data(image_name)
+        return [image['tag'] for image in cache]
+
+    # repository listing fields that change whenever a tag is pushed
+    FINGERPRINT_FIELDS = ('updatedDate', 'latestTag', 'latestImageSize',
+                          'latestImageDigest')
+
+    def repo_fingerprint(self, repo):
+        fields = ["{}={}".format(field, repo[field])
+                  for field in self.FINGERPRINT_FIELDS if repo.get(field)]
+        return ";".join(fields) or None
 
-    def _get_image_data(self, image_name):
+    def _get_image_data(self, image_name, revalidate=True):
         """
         Returns tags and other attributes of interest for each version of
-        `image_name`
+        `image_name`; see `_get` for `revalidate`
 
         :param image_name: should consist of `<project>/<repo>`, e.g.
             `nvidia/caffe`
@@ -249,13 +314,25 @@ class NGCRegistry(BaseRegistry):
         """
         org_name, repo_name = image_name.split('/')
         endpoint = "org/{}/repos/{}/images".format(org_name, repo_name)
-        return self._get(endpoint).get('images', [])
+        return self._get(endpoint, revalidate=revalidate).get('images', [])
 
-    def get_state(self, project=None, filter_fn=None):
-        names = self.get_image_names(project=project)
+    def get_state(self, project=None, filter_fn=None, max_workers=None,
+                  name_filter_fn=None, catalog=None, resolve_digests=False):
+        """
+        See `BaseRegistry.get_state`.  The `docker_id` of each tag is its
+        `updatedDate` unless `resolve_digests` is set, in which case every
+        selected tag is resolved to its manifest digest with a HEAD request
+        against the registry, so that metadata-only updates on NGC do not
+        look like new content.  Entries keep the `updated_date` and, when
+        resolved, the `digest` of the tag.
+        """
+        if catalog is None:
+            catalog = self.snapshot()
+        names = self.filter_image_names(catalog.image_names(project=project),
+                                        name_filter_fn)
         state = collections.defaultdict(dict)
-        for name in names:
-            image_data = self._get_image_data(name)
+        for name, image_data in self._map_images(catalog.image_data, names,
+                                                 max_workers=max_workers):
             for image in image_data:
                 tag = image["tag"]
                 docker_id = image["updatedDate"]
@@ -266,6 +343,41 @@ class NGCRegistry(BaseRegistry):
                         continue
                 state[name][tag] = {
                     "docker_id": docker_id,
+                    "updated_date": docker_id,
                     "registry": "nvcr.io",
+                    "size": image.get("size"),
                 }
+        if resolve_digests:
+            self._resolve_digests(state, max_workers=max_workers,
+                                  catalog=catalog)
         return state
+
+    def get_digest(self, image_name, tag):
+        return self.v2.get_digest(image_name, tag)
+
+    def _resolve_digests(self, state, max_workers=None, catalog=None):
+        def digest(name_tag):
+            name, tag = name_tag
+            updated_date = state[name][tag]["updated_date"]
+            if catalog is not None:
+                cached = catalog.digest(name, tag, updated_date)
+                if cached:
+                    return cached
+            try:
+                value = self.get_digest(name, tag)
+                if value and catalog is not None:
+                    catalog.record_digest(name, tag, updated_date, value)
+                return value
+            except Exception as err:
+                log.warning("unable to resolve digest of {}:{}; falling back "
+                            "to updatedDate: {}".format(name_tag[0],
+                                                        name_tag[1], err))
+                return None
+
+        name_tags = [(name, tag) for name, tags in state.items()
+                     for tag in tags]
+        for (name, tag), value in self._map_images(digest, name_tags,
+                                                   max_workers=max_workers):
+            if value:
+                state[name][tag]["digest"] = value
+                state[name][tag]["docker_id"] = value
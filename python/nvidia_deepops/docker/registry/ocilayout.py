@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017, NVIDIA CORPORATION. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of NVIDIA CORPORATION nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from nvidia_deepops import utils
+from nvidia_deepops.docker.registry.dockregistry import RegistryError
+
+
+__all__ = ('OCILayout',)
+
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+
+REF_NAME = 'org.opencontainers.image.ref.name'
+
+
+class OCILayout:
+    """
+    Writes images into an OCI image layout directory: a single
+    content-addressed `blobs/sha256` store shared by every image plus an
+    `index.json` with one entry per `name:tag`.
+
+    Layers common to several images or tags are stored once.  `OCILayout`
+    implements the target side of the `ImageCopier` interface, so images are
+    exported with `ImageCopier(source, OCILayout(path)).copy(name, tag)`.
+
+    :param str path: layout directory; created if missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.url = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'blobs', 'sha256'), exist_ok=True)
+        layout = os.path.join(path, 'oci-layout')
+        if not os.path.exists(layout):
+            with open(layout, 'w') as file:
+                json.dump({'imageLayoutVersion': '1.0.0'}, file)
+
+    def blob_path(self, digest):
+        algorithm, hexdigest = digest.split(':', 1)
+        return os.path.join(self.path, 'blobs', algorithm, hexdigest)
+
+    def blob_exists(self, name, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def mount_blob(self, name, digest, from_name):
+        # blobs are shared by all images of the layout
+        return self.blob_exists(name, digest)
+
+    def upload_blob(self, name, digest, data):
+        """
+        Streams `data` (bytes or an iterable of byte chunks) into the blob
+        store; the content is verified against `digest` before it becomes
+        visible
+        """
+        if isinstance(data, bytes):
+            data = [data]
+        sha256 = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.path, 'blobs'))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in data:
+                    sha256.update(chunk)
+                    file.write(chunk)
+            actual = 'sha256:' + sha256.hexdigest()
+            if actual != digest:
+                raise RegistryError('digest mismatch for {}: got {}'.format(
+                    digest, actual))
+            os.replace(tmp, self.blob_path(digest))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return digest
+
+    def put_manifest(self, name, reference, content, media_type):
+        """
+        Stores a manifest blob; when `reference` is a tag rather than a
+        digest, the manifest is also recorded in `index.json` as `name:tag`,
+        replacing any previous entry of that name
+        """
+        digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+        if not self.blob_exists(name, digest):
+            self.upload_blob(name, digest, content)
+        if ':' in reference:
+            return digest
+        ref = '{}:{}'.format(name, reference)
+        descriptor = {
+            'mediaType': media_type,
+            'digest': digest,
+            'size': len(content),
+            'annotations': {REF_NAME: ref},
+        }
+        with self._lock:
+            index = self.index()
+            index['manifests'] = [
+                entry for entry in index['manifests']
+                if entry.get('annotations', {}).get(REF_NAME) != ref]
+            index['manifests'].append(descriptor)
+            self._write_index(index)
+        log.debug("{} --> {} in {}".format(ref, digest, self.path))
+        return digest
+
+    def index(self):
+        try:
+            with open(os.path.join(self.path, 'index.json'), 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'schemaVersion': 2, 'manifests': []}
+
+    def _write_index(self, index):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(tmp, os.path.join(self.path, 'index.json'))
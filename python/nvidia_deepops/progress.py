@@ -32,13 +32,15 @@ import itertools
 import json
 import logging
 import os
+import threading
+import time
 
-import requests
 import yaml
 
 from contextlib import contextmanager
 
 from . import utils
+from .session import Session
 
 log = utils.get_logger(__name__, level=logging.INFO)
 
@@ -49,6 +51,10 @@ STATES = {
     "error": "error",
 }
 
+# the transfer of a step sized by `add_step`
+DEFAULT_TRANSFER = "transfer"
+
+
 def filename(name, path=None):
     path = path or "/tmp"
     sha256 = hashlib.sha256()
@@ -65,21 +71,219 @@ def load_state(name, progress_uri=None, path=None):
         p.read_prgress(_filename)
     yield p
     p.write_progress(_filename)
+    p.close()
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing endpoint.  After `failure_threshold` consecutive
+    failures the breaker opens and `allow` returns False for `reset_timeout`
+    seconds; then a single trial call is let through, which closes the breaker
+    again on success.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                # half-open: re-arm so that only this call is let through
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    log.warning(
+                        "progress endpoint failed {} times; "
+                        "pausing updates for {}s".format(
+                            self._failures, self.reset_timeout))
+                self._opened_at = time.monotonic()
+
+
+class Publisher:
+    """
+    Sends progress snapshots from a background thread.  `publish` only replaces
+    the pending snapshot, so rapid updates coalesce into the latest one, which
+    is sent at most once every `interval` seconds.  Snapshots are dropped while
+    the circuit `breaker` is open.
+    """
+
+    def __init__(self, send, interval=1.0, breaker=None):
+        self._send = send
+        self.interval = interval
+        self.breaker = breaker or CircuitBreaker()
+        self._pending = None
+        self._busy = False
+        self._closed = False
+        self._last = 0
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def publish(self, data):
+        with self._cond:
+            self._pending = data
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                delay = self.interval - (time.monotonic() - self._last)
+                if delay > 0 and not self._closed:
+                    self._cond.wait(delay)
+                    continue
+                data, self._pending = self._pending, None
+                self._busy = True
+            try:
+                if self.breaker.allow():
+                    try:
+                        self._send(data)
+                        self.breaker.success()
+                    except Exception as err:
+                        self.breaker.failure()
+                        log.warning("progress update failed with {}".format(
+                            str(err)))
+            finally:
+                with self._cond:
+                    self._last = time.monotonic()
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for the pending snapshot to be sent.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while (self._pending is not None or self._busy) and \
+                    self._thread is not None:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout=None):
+        """
+        Sends the pending snapshot without further delay and stops the thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
 
 
 class Progress:
+    """
+    Progress of a multi-step job, posted as JSON to `uri`.
+
+    Posts are handed to a background `Publisher`, so a slow or unreachable
+    endpoint never blocks the caller.
+
+    The transfers of a step, e.g. its pull and its save, are counted
+    separately, each against its own total in bytes declared with `expect`
+    or the `size` of `add_step`.  They add up to the aggregate `percent`,
+    `throughput` (bytes per second over the last `window` seconds) and `eta`
+    (seconds) of `data`.  Transfers report their bytes with `advance`.
+
+    :param float interval: minimum seconds between two posts
+    :param float timeout: seconds before a post is abandoned
+    """
 
-    def __init__(self, *, uri=None, progress_length_unknown=False):
+    def __init__(self, *, uri=None, progress_length_unknown=False,
+                 session=None, interval=1.0, timeout=10, window=30):
         self.uri = uri
+        self._session = session
+        self.timeout = timeout
+        self.interval = interval
+        self.window = window
         self.steps = collections.OrderedDict()
         self.progress_length_unknown = progress_length_unknown
+        self._bytes = {}
+        self._samples = collections.deque()
+        self._last_advance = 0
+        self._lock = threading.RLock()
+        self.publisher = Publisher(self._send, interval=interval)
 
-    def add_step(self, *, key, status=None, header=None, subHeader=None):
-        self.steps[key] = {
-            "status": STATES.get(status, "waiting"),
-            "header": header or key,
-            "subHeader": subHeader or ""
-        }
+    def add_step(self, *, key, status=None, header=None, subHeader=None,
+                 size=None):
+        with self._lock:
+            self.steps[key] = {
+                "status": STATES.get(status, "waiting"),
+                "header": header or key,
+                "subHeader": subHeader or ""
+            }
+            self._bytes.pop(key, None)
+        self.expect(key, DEFAULT_TRANSFER, size)
+
+    def expect(self, key, transfer, size):
+        """
+        Declares that step `key` moves `size` bytes in its `transfer`; a
+        transfer of unknown size is not counted.
+        """
+        if not size:
+            return
+        with self._lock:
+            if key in self.steps:
+                self._bytes.setdefault(key, {})[transfer] = [0, size]
+
+    def reset(self):
+        """
+        Forgets every step, e.g. before the next cycle of a long-running job.
+        """
+        with self._lock:
+            self.steps.clear()
+            self._bytes.clear()
+            self._samples.clear()
+
+    def advance(self, key, nbytes, transfer=None):
+        """
+        Records `nbytes` more bytes done by `transfer` of step `key`, without
+        exceeding its size, and posts at most once per `interval`.  Cheap
+        enough to be called for every chunk of a transfer.
+        """
+        with self._lock:
+            transfer = transfer or DEFAULT_TRANSFER
+            counter = self._bytes.get(key, {}).get(transfer)
+            if counter is None:
+                return
+            counter[0] = min(counter[0] + nbytes, counter[1])
+            now = time.monotonic()
+            due = now - self._last_advance >= self.interval
+            if due:
+                self._last_advance = now
+        if due:
+            self.post()
 
     def set_infinite_progress(self):
         self.progress_length_unknown = True
@@ -88,12 +292,16 @@ class Progress:
         self.progress_length_unknown = False
 
     def update_step(self, *, key, status, header=None, subHeader=None):
-        step = self.steps[key]
-        step["status"] = STATES[status]
-        if header:
-            step["header"] = header
-        if subHeader:
-            step["subHeader"] = subHeader
+        with self._lock:
+            step = self.steps[key]
+            step["status"] = STATES[status]
+            if header:
+                step["header"] = header
+            if subHeader:
+                step["subHeader"] = subHeader
+            if step["status"] == STATES["complete"]:
+                for counter in self._bytes.get(key, {}).values():
+                    counter[0] = counter[1]
 
     def write_progress(self, path):
         ordered_data = {
@@ -119,8 +327,10 @@ class Progress:
 
 
     @contextmanager
-    def run_step(self, *, key, post_on_complete=True, progress_length_unknown=None):
-        progress_length_unknown = progress_length_unknown or self.progress_length_unknown
+    def run_step(self, *, key, post_on_complete=True,
+                 progress_length_unknown=None):
+        progress_length_unknown = progress_length_unknown or \
+            self.progress_length_unknown
         step = self.steps[key]
         step["status"] = STATES["running"]
         self.post(progress_length_unknown=progress_length_unknown)
@@ -138,21 +348,69 @@ class Progress:
 
 
     def data(self, progress_length_unknown=False):
-        progress_length_unknown = progress_length_unknown or self.progress_length_unknown
-        steps = [v for _, v in self.steps.items()]
+        progress_length_unknown = progress_length_unknown or \
+            self.progress_length_unknown
+        with self._lock:
+            steps = [dict(v) for _, v in self.steps.items()]
+            completed, total, throughput, eta = self.transfer()
+        if progress_length_unknown:
+            percent = -2
+        elif total:
+            percent = round(100.0 * completed / total, 1)
+        else:
+            percent = -1
         return {
-            "percent": -2 if progress_length_unknown else -1,
-            "steps": steps
+            "percent": percent,
+            "steps": steps,
+            "bytes": {"completed": completed, "total": total},
+            "throughput": throughput,
+            "eta": eta,
         }
 
+    def transfer(self):
+        """
+        Returns the bytes completed and in total over all sized transfers,
+        the throughput in bytes per second and the estimated seconds
+        remaining, which is None while the throughput is unknown.
+        """
+        with self._lock:
+            counters = [counter for transfers in self._bytes.values()
+                        for counter in transfers.values()]
+            completed = sum(counter[0] for counter in counters)
+            total = sum(counter[1] for counter in counters)
+            now = time.monotonic()
+            self._samples.append((now, completed))
+            while len(self._samples) > 2 and \
+                    now - self._samples[1][0] >= self.window:
+                self._samples.popleft()
+            then, done_then = self._samples[0]
+        throughput = 0
+        if now > then and completed > done_then:
+            throughput = int((completed - done_then) / (now - then))
+        eta = None
+        if throughput:
+            eta = int((total - completed) / throughput)
+        return completed, total, throughput, eta
+
     def post(self, progress_length_unknown=None):
-        progress_length_unknown = progress_length_unknown or self.progress_length_unknown
+        progress_length_unknown = progress_length_unknown or \
+            self.progress_length_unknown
         data = self.data(progress_length_unknown=progress_length_unknown)
         log.debug(data)
         if self.uri:
-            try:
-                r = requests.post(self.uri, json=data)
-                r.raise_for_status()
-            except Exception as err:
-                log.warn("progress update failed with {}".format(str(err)))
+            self.publisher.publish(data)
+
+    def _send(self, data):
+        if self._session is None:
+            self._session = Session(pool_size=1)
+        r = self._session.post(self.uri, json=data, timeout=self.timeout)
+        r.raise_for_status()
+
+    def flush(self, timeout=None):
+        """Waits at most `timeout` seconds for the latest update to be sent."""
+        return self.publisher.flush(timeout=timeout)
+
+    def close(self, timeout=None):
+        """Sends the latest update, waiting at most `timeout` seconds."""
+        self.publisher.close(timeout=timeout)
 
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2017, NVIDIA CORPORATION. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#  * Neither the name of NVIDIA CORPORATION nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY
+# OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from . import utils
+
+
+__all__ = ('RateLimiter', 'RetryPolicy', 'Session')
+
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for transient HTTP failures.
+
+    A request whose method is in `methods` is retried up to `retries` times
+    when the connection fails or the response status is in `statuses`; by
+    default only idempotent methods are, so that e.g. a POST opening a blob
+    upload is never sent twice.  The n-th retry waits a random
+    time between 0 and `backoff * 2**n` seconds, capped at `max_backoff`; a
+    `Retry-After` header on the response takes precedence.
+
+    :param int retries: maximum number of retries per request
+    :param float backoff: base delay in seconds
+    :param float max_backoff: upper bound on any single delay in seconds
+    :param statuses: response status codes that are retried
+    :param methods: HTTP methods that are retried
+    """
+
+    STATUSES = (429, 500, 502, 503, 504)
+    METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+    def __init__(self, *, retries=3, backoff=0.5, max_backoff=60,
+                 statuses=STATUSES, methods=METHODS):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+
+    def should_retry(self, attempt, response=None, method="GET"):
+        if attempt >= self.retries or method.upper() not in self.methods:
+            return False
+        return response is None or response.status_code in self.statuses
+
+    def delay(self, attempt, response=None):
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.backoff * 2 ** attempt,
+                                     self.max_backoff))
+
+    @staticmethod
+    def retry_after(response):
+        """
+        Returns the delay in seconds requested by a `Retry-After` header,
+        which may be a number of seconds or an HTTP date, or None
+        """
+        value = response.headers.get("Retry-After") if response is not None \
+            else None
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(when.timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket allowing `rate` requests per second on average
+    and bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _replayable(kwargs):
+    data = kwargs.get("data")
+    return data is None or isinstance(data, (bytes, str, dict, list, tuple))
+
+
+class Session(requests.Session):
+    """
+    `requests.Session` backed by a tunable pool of keep-alive connections.
+
+    A registry object should own a single `Session` and issue every request
+    through it so that a full catalog walk reuses a handful of TCP/TLS
+    connections instead of opening a new one per request.  Every request is
+    throttled by the optional `rate_limiter` and retried according to the
+    `retry` policy; requests with streamed bodies, and by default POSTs, are
+    never retried.
+
+    :param int pool_size: maximum number of connections kept open per host;
+        should be at least the number of threads sharing the session
+    :param bool keep_alive: when False, every request asks the server to close
+        the connection once the response has been read
+    :param int retries: number of retries of the default `RetryPolicy`
+    :param RetryPolicy retry: retry policy; overrides `retries`
+    :param RateLimiter rate_limiter: optional limiter, may be shared between
+        sessions talking to the same API
+    """
+
+    def __init__(self, *, pool_size=10, keep_alive=True, retries=0,
+                 retry=None, rate_limiter=None):
+        super(Session, self).__init__()
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.retry = retry or RetryPolicy(retries=retries)
+        self.rate_limiter = rate_limiter
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+
+    def request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            response = None
+            try:
+                response = super(Session, self).request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if not (_replayable(kwargs) and
+                        self.retry.should_retry(attempt, method=method)):
+                    raise
+                reason = str(err)
+            else:
+                if not (_replayable(kwargs) and self.retry.should_retry(
+                        attempt, response, method=method)):
+                    return response
+                reason = "HTTP {}".format(response.status_code)
+            delay = self.retry.delay(attempt, response)
+            if response is not None:
+                response.close()
+            attempt += 1
+            log.warning(
+                "{} {} failed with {}; retry {}/{} in {:.1f} sec".format(
+                    method, url, reason, attempt, self.retry.retries, delay))
+            time.sleep(delay)
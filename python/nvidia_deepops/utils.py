@@ -26,27 +26,95 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import atexit
 import contextlib
 import logging
+import logging.handlers
 import os
+import pprint
+import queue
 import shlex
 import subprocess
 import sys
+import threading
+
+_handler = None
+_handler_lock = threading.Lock()
+
+
+def _queue_handler():
+    # one handler shared by every logger; records are formatted on the calling
+    # thread and written to stdout by a single listener thread
+    global _handler
+    with _handler_lock:
+        if _handler is None:
+            records = queue.Queue()
+            ch = logging.StreamHandler(sys.stdout)
+            ch.setLevel(logging.DEBUG)
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - '
+                '%(message)s')
+            ch.setFormatter(formatter)
+            listener = logging.handlers.QueueListener(
+                records, ch, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            _handler = logging.handlers.QueueHandler(records)
+            _handler.addFilter(_once)
+        return _handler
+
+
+def _once(record):
+    # a record propagating from a child logger reaches the shared handler again
+    # on every ancestor that was also set up by get_logger
+    if getattr(record, "_queued", False):
+        return False
+    record._queued = True
+    return True
 
 
 def get_logger(name, level=None):
     level = level or logging.INFO
     log = logging.getLogger(name)
     log.setLevel(level)
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    log.addHandler(ch)
+    handler = _queue_handler()
+    if handler not in log.handlers:
+        log.addHandler(handler)
     return log
 
 
+class lazy:
+    """
+    Log argument rendered by `fn(*args, **kwargs)` only when a record is
+    emitted, e.g. `log.debug("GOT %s", lazy(json.dumps, data))` costs nothing
+    while DEBUG is disabled.
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.fn(*self.args, **self.kwargs))
+
+
+def lazy_pformat(obj, indent=4):
+    """
+    Pretty-prints `obj` for a log message only if the message is emitted.
+    """
+    return lazy(pprint.pformat, obj, indent=indent)
+
+
+def counted(chunks, progress):
+    """
+    Yields `chunks` unchanged, reporting the length of each to `progress`.
+    """
+    for chunk in chunks:
+        progress(len(chunk))
+        yield chunk
+
+
 def execute(command, stdout=None, stderr=None):
     stdout = stdout or sys.stdout
     stderr = stderr or sys.stderr
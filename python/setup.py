@@ -35,6 +35,7 @@ requirements = [
     'Click>=6.0',
     'docker',
     'contexttimer',
+    'requests',
     # TODO: put package requirements here
 ]
 
@@ -30,6 +30,8 @@
 import collections
 import logging
 import os
+import threading
+import time
 # import pprint
 
 import pytest
@@ -39,13 +41,14 @@ import traceback
 from click.testing import CliRunner
 from docker.errors import APIError
 
-from nvidia_deepops import utils
+from nvidia_deepops import session, utils
+from nvidia_deepops.cache import ResponseCache
 # from nvidia_deepops import cli
 from nvidia_deepops.docker import (BaseClient, DockerClient, registry)
 
 
 BaseRegistry = registry.BaseRegistry
-# DockerRegistry = registry.DockerRegistry
+DockerRegistry = registry.DockerRegistry
 DGXRegistry = registry.DGXRegistry
 NGCRegistry = registry.NGCRegistry
 
@@ -136,6 +139,7 @@ class FakeRegistry(BaseRegistry):
 
     def __init__(self, url, images=None):
         self.url = url
+        self.listed = []
         self.images = collections.defaultdict(list)
         images = images or {}
         for name, tags in images.items():
@@ -173,11 +177,15 @@ class FakeRegistry(BaseRegistry):
             return True
         return [name for name in self.images.keys() if predicate(name)]
 
-    def get_state(self, project=None, filter_fn=None):
-        image_names = self.get_image_names(project=project)
+    def get_state(self, project=None, filter_fn=None, max_workers=None,
+                  name_filter_fn=None):
+        image_names = self.filter_image_names(
+            self.get_image_names(project=project), name_filter_fn)
         state = collections.defaultdict(dict)
-        for name in image_names:
-            for tag in self.images[name]:
+        for name, tags in self._map_images(self.get_image_tags, image_names,
+                                           max_workers=max_workers):
+            self.listed.append(name)
+            for tag in tags:
                 if filter_fn is not None and callable(filter_fn):
                     if not filter_fn(name=name, tag=tag, docker_id=tag):
                         continue
@@ -239,6 +247,701 @@ def test_get_state_filter(nvcr):
     assert len(state["nvidia/pytorch"].keys()) == 1
 
 
+@pytest.mark.parametrize("max_workers", [None, 1, 4])
+def test_map_images(nvcr, max_workers):
+    names = nvcr.get_image_names(project="nvidia")
+    results = nvcr._map_images(nvcr.get_image_tags, names,
+                               max_workers=max_workers)
+    assert [name for name, _ in results] == names
+    assert dict(results)["nvidia/pytorch"] == ["17.07", "17.05"]
+
+
+def test_map_images_raises(nvcr):
+    def fail(name):
+        raise ValueError(name)
+    with pytest.raises(ValueError):
+        nvcr._map_images(fail, ["a", "b", "c"], max_workers=2)
+
+
+def test_get_logger_shares_handler():
+    log = utils.get_logger("test.get_logger", level=logging.INFO)
+    handlers = list(log.handlers)
+    assert len(handlers) == 1
+    assert utils.get_logger("test.get_logger",
+                            level=logging.DEBUG).handlers == handlers
+    assert utils.get_logger("test.get_logger.other").handlers == handlers
+
+    rendered = []
+
+    def render(data):
+        rendered.append(data)
+        return str(data)
+
+    log.setLevel(logging.INFO)
+    log.debug("GOT %s", utils.lazy(render, {"a": 1}))
+    assert rendered == []
+    log.info("GOT %s", utils.lazy(render, {"a": 1}))
+    assert rendered and rendered[0] == {"a": 1}
+
+    record = logging.LogRecord("test.get_logger.other", logging.INFO,
+                               __file__, 0, "x", None, None)
+    assert handlers[0].filter(record)
+    assert not handlers[0].filter(record)
+
+
+def test_session_pool():
+    http = session.Session(pool_size=3, keep_alive=False, retries=2)
+    adapter = http.get_adapter("https://api.ngc.nvidia.com")
+    assert adapter._pool_maxsize == 3
+    assert http.retry.retries == 2
+    assert http.headers["Connection"] == "close"
+
+
+def test_session_retries(monkeypatch):
+    statuses = [502, 429, 200]
+    sleeps = []
+
+    def send(self, method, url, **kwargs):
+        status = statuses.pop(0)
+        headers = {"Retry-After": "7"} if status == 429 else {}
+        return FakeResponse(url, status_code=status, headers=headers)
+    monkeypatch.setattr(session.requests.Session, "request", send)
+    monkeypatch.setattr(session.time, "sleep", sleeps.append)
+
+    http = session.Session(retry=session.RetryPolicy(retries=3, backoff=1))
+    assert http.get("https://api.ngc.nvidia.com/v2/orgs").status_code == 200
+    assert 0 <= sleeps[0] <= 1
+    assert sleeps[1] == 7
+
+    statuses.extend([503, 503])
+    http = session.Session(retries=1)
+    assert http.get("https://api.ngc.nvidia.com/v2/orgs").status_code == 503
+
+    # a POST is not idempotent and is sent once unless it opts in
+    statuses[:] = [503, 200]
+    uploads = "https://registry:5000/v2/busybox/blobs/uploads/"
+    assert http.post(uploads).status_code == 503
+    assert statuses == [200]
+    http = session.Session(retry=session.RetryPolicy(
+        retries=1, backoff=0, methods=("GET", "POST")))
+    assert http.post(uploads).status_code == 200
+
+
+def test_rate_limiter():
+    limiter = session.RateLimiter(rate=50, burst=5)
+    start = time.monotonic()
+    for _ in range(10):
+        limiter.acquire()
+    # the burst passes immediately, the remaining 5 take ~0.1 sec
+    assert 0.07 < time.monotonic() - start < 0.5
+
+
+def test_response_cache(tmpdir):
+    cache = ResponseCache(str(tmpdir), max_age=60)
+    url = "https://api.ngc.nvidia.com/v2/org/nvidia/repos"
+    assert cache.get(url) is None
+    cache.put(url, {"repositories": []}, etag='"abc"')
+    entry = cache.get(url)
+    assert entry["data"] == {"repositories": []}
+    assert cache.is_fresh(entry)
+    assert cache.validators(entry) == {"If-None-Match": '"abc"'}
+    # entries survive a restart
+    assert ResponseCache(str(tmpdir)).get(url)["etag"] == '"abc"'
+
+
+def test_response_cache_eviction(tmpdir):
+    cache = ResponseCache(str(tmpdir), max_size=250)
+    cache.put("a", "x" * 100)
+    cache.put("b", "y" * 100)
+    assert cache.get("a") is None
+    assert cache.get("b")["data"] == "y" * 100
+    # the limit is measured in bytes on disk, not in characters
+    cache.put("c", "\u00e9" * 10)
+    assert cache.get("c")["data"] == "\u00e9" * 10
+    assert sum(size for size, _ in cache._index.values()) == sum(
+        os.path.getsize(os.path.join(str(tmpdir), name))
+        for name in os.listdir(str(tmpdir)))
+    expired = ResponseCache(str(tmpdir), ttl=-1)
+    assert expired.get("b") is None
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_get_state_name_filter(nvcr):
+    def name_filter(*, name):
+        return "pytorch" in name
+
+    state = nvcr.get_state(project="nvidia", name_filter_fn=name_filter)
+    assert list(state.keys()) == ["nvidia/pytorch"]
+    # tags are only listed for images passing the name filter
+    assert nvcr.listed == ["nvidia/pytorch"]
+
+
+@pytest.fixture
+def dgx():
+    responses = {
+        "repository?includePublic=true": {"repositories": [
+            {"namespace": "nvidia", "name": "caffe", "description": "# Caffe"},
+            {"namespace": "nvidia", "name": "cuda", "description": "# CUDA"},
+            {"namespace": "hpc", "name": "namd"},
+        ]},
+        "repository/nvidia/caffe": {"tags": [
+            {"name": "17.12", "dockerImageId": "sha256:aaa", "size": 10},
+        ]},
+        "repository/nvidia/cuda": {"tags": [
+            {"name": "9.0-devel", "dockerImageId": "sha256:bbb", "size": 20},
+        ]},
+    }
+    registry = DGXRegistry("0" * 40)
+    registry.requested = []
+
+    def _get(endpoint):
+        registry.requested.append(endpoint)
+        return responses[endpoint]
+    registry._get = _get
+    return registry
+
+
+def test_catalog_snapshot(dgx):
+    catalog = dgx.snapshot()
+    state = dgx.get_state(project="nvidia", catalog=catalog, max_workers=2)
+    assert state["nvidia/caffe"]["17.12"]["docker_id"] == "sha256:aaa"
+    assert catalog.image_descriptions(project="nvidia") == {
+        "nvidia/caffe": "# Caffe", "nvidia/cuda": "# CUDA"}
+    assert catalog.image_tags("nvidia/cuda") == ["9.0-devel"]
+    assert catalog.image_names(project="hpc") == ["hpc/namd"]
+    # every endpoint is fetched exactly once
+    assert sorted(dgx.requested) == ["repository/nvidia/caffe",
+                                     "repository/nvidia/cuda",
+                                     "repository?includePublic=true"]
+
+    # without fingerprints, only repositories that are new since the last run
+    # count as changed
+    catalog = dgx.snapshot(fingerprints=catalog.fingerprints())
+    assert catalog.changed(project="nvidia") == set()
+    assert catalog.changed() == {"hpc/namd"}
+
+
+def test_progress_publisher_coalesces():
+    from nvidia_deepops import progress
+    sent = []
+    release = threading.Event()
+
+    def send(data):
+        release.wait(5)
+        sent.append(data)
+
+    publisher = progress.Publisher(send, interval=0)
+    started = time.monotonic()
+    for i in range(50):
+        publisher.publish(i)
+    assert time.monotonic() - started < 1
+    release.set()
+    assert publisher.flush(timeout=5)
+    publisher.close()
+    # the first update may already be in flight; the rest collapse into the
+    # last one
+    assert sent[-1] == 49 and len(sent) <= 2
+
+
+def test_progress_bytes(monkeypatch):
+    from nvidia_deepops import progress
+    clock = [100.0]
+    monkeypatch.setattr(progress.time, "monotonic", lambda: clock[0])
+    p = progress.Progress(interval=3600)
+    p.add_step(key="query")
+    p.add_step(key="nvidia/cuda:10.0", size=1000)
+    p.add_step(key="nvidia/pytorch:20.03", size=3000)
+    assert p.data()["percent"] == 0
+    clock[0] += 10
+    p.advance("nvidia/cuda:10.0", 600)
+    p.advance("nvidia/cuda:10.0", 600)
+    p.advance("query", 50)
+    data = p.data()
+    assert data["bytes"] == {"completed": 1000, "total": 4000}
+    assert data["percent"] == 25.0
+    assert data["throughput"] == 100 and data["eta"] == 30
+    p.update_step(key="nvidia/pytorch:20.03", status="complete")
+    assert p.data()["percent"] == 100.0
+    assert p.data(progress_length_unknown=True)["percent"] == -2
+
+
+def test_progress_transfers():
+    from nvidia_deepops import progress
+    p = progress.Progress(interval=3600)
+    p.add_step(key="nvidia/cuda:10.0")
+    p.expect("nvidia/cuda:10.0", "pull", 1000)
+    p.advance("nvidia/cuda:10.0", 1500, "pull")
+    p.advance("nvidia/cuda:10.0", 100, "save")
+    assert p.data()["bytes"] == {"completed": 1000, "total": 1000}
+    # the save is counted against the size of the image in the daemon
+    p.expect("nvidia/cuda:10.0", "save", 3000)
+    p.advance("nvidia/cuda:10.0", 1500, "save")
+    assert p.data()["bytes"] == {"completed": 2500, "total": 4000}
+    p.update_step(key="nvidia/cuda:10.0", status="complete")
+    assert p.data()["bytes"] == {"completed": 4000, "total": 4000}
+
+
+def test_follow_pull():
+    from nvidia_deepops.docker.client.base import follow_pull
+    events = [
+        {"status": "Pulling from nvidia/cuda", "id": "10.0"},
+        {"status": "Pulling fs layer", "id": "a", "progressDetail": {}},
+        {"status": "Downloading", "id": "a",
+         "progressDetail": {"current": 100, "total": 300}},
+        {"status": "Downloading", "id": "b",
+         "progressDetail": {"current": 50, "total": 50}},
+        {"status": "Extracting", "id": "b",
+         "progressDetail": {"current": 20, "total": 80}},
+        {"status": "Downloading", "id": "a",
+         "progressDetail": {"current": 250, "total": 300}},
+        {"status": "Download complete", "id": "a", "progressDetail": {}},
+        {"status": "Download complete", "id": "b", "progressDetail": {}},
+    ]
+    reported = []
+    follow_pull(iter(events), reported.append)
+    assert reported == [100, 50, 150, 50]
+    with pytest.raises(RuntimeError):
+        follow_pull(iter([{"error": "manifest unknown"}]), reported.append)
+
+
+def test_progress_circuit_breaker():
+    from nvidia_deepops import progress
+    calls = []
+
+    def send(data):
+        calls.append(data)
+        raise IOError("unreachable")
+
+    breaker = progress.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    publisher = progress.Publisher(send, interval=0, breaker=breaker)
+    for i in range(5):
+        publisher.publish(i)
+        publisher.flush(timeout=5)
+    publisher.close()
+    assert breaker.is_open
+    assert len(calls) == 2
+
+
+class FakeResponse:
+
+    def __init__(self, url, data=None, status_code=200, headers=None,
+                 links=None):
+        self.url = url
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.links = links or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeV2Session:
+    """
+    Serves a paginated v2 API for `images` ({name: {tag: digest}}).
+    """
+
+    def __init__(self, url, images):
+        self.url = url
+        self.images = images
+        self.requested = []
+
+    def page(self, url, key, items, n, last):
+        items = sorted(items)
+        if last:
+            items = [item for item in items if item > last]
+        links = {}
+        if len(items) > n:
+            links["next"] = {"url": "{}?n={}&last={}".format(
+                url.replace(self.url, ""), n, items[n - 1])}
+        return FakeResponse(url, {key: items[:n]}, links=links)
+
+    def request(self, method, url, auth=None, verify=None, headers=None):
+        from urllib.parse import parse_qs, urlsplit
+        self.requested.append((method, url))
+        parts = urlsplit(url)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        n, last = int(query.get("n", 1000)), query.get("last")
+        path = parts.path[len("/v2/"):]
+        if path == "_catalog":
+            return self.page(parts.path, "repositories", self.images, n, last)
+        if path.endswith("/tags/list"):
+            name = path[:-len("/tags/list")]
+            return self.page(parts.path, "tags", self.images[name], n, last)
+        name, reference = path.split("/manifests/")
+        return FakeResponse(url, headers={
+            "Docker-Content-Digest": self.images[name][reference]})
+
+
+@pytest.fixture
+def v2():
+    session = FakeV2Session("https://registry:5000", {
+        "nvidia/cuda": {"9.0-devel": "sha256:c9", "10.0-devel": "sha256:c10"},
+        "nvidia/pytorch": {"17.05": "sha256:p5", "17.06": "sha256:p6",
+                           "17.07": "sha256:p7"},
+        "hpc/namd": {"2.12": "sha256:n2"},
+    })
+    return DockerRegistry(url="registry:5000", session=session, page_size=2)
+
+
+def test_docker_registry_pagination(v2):
+    assert v2.get_image_names() == ["hpc/namd", "nvidia/cuda",
+                                    "nvidia/pytorch"]
+    assert v2.get_image_names(project="nvidia") == ["nvidia/cuda",
+                                                    "nvidia/pytorch"]
+    assert v2.get_image_tags("nvidia/pytorch") == ["17.05", "17.06", "17.07"]
+    catalog_pages = [url for _, url in v2._session.requested
+                     if "_catalog" in url]
+    assert len(catalog_pages) == 4
+
+
+def test_docker_registry_streamed_upload_not_retried():
+    class Session:
+        puts = []
+
+        def request(self, method, url, auth=None, verify=None, data=None,
+                    headers=None):
+            if method == "POST":
+                return FakeResponse(url, status_code=202, headers={
+                    "Location": "/v2/busybox/blobs/uploads/1"})
+            self.puts.append(b"".join(data))
+            return FakeResponse(url, status_code=401, headers={
+                "Www-Authenticate":
+                    'Bearer realm="https://auth/token",service="registry"'})
+
+        def get(self, url, params=None, auth=None, verify=None):
+            return FakeResponse(url, {"token": "token"})
+
+    v2 = DockerRegistry(url="registry:5000", session=Session())
+    with pytest.raises(registry.RegistryError) as err:
+        v2.upload_blob("busybox", "sha256:b", iter([b"layer", b"data"]))
+    assert err.value.code == 401
+    # the consumed chunks are not sent again as an empty blob
+    assert Session.puts == [b"layerdata"]
+
+
+def test_docker_registry_get_state(v2):
+    state = v2.get_state(project="nvidia", max_workers=4)
+    assert state["nvidia/pytorch"]["17.06"] == {
+        "docker_id": "sha256:p6", "registry": "registry:5000"}
+    assert len(state["nvidia/cuda"]) == 2
+    assert "hpc/namd" not in state
+
+    # a shared snapshot lists the catalog once for every query
+    catalog = v2.snapshot()
+    del v2._session.requested[:]
+    assert v2.get_state(project="nvidia", catalog=catalog) == state
+    assert catalog.image_names(project="hpc") == ["hpc/namd"]
+    pages = [url for _, url in v2._session.requested if "_catalog" in url]
+    assert len(pages) == 2
+    # tags are identified by digest whether or not it is asked for
+    assert v2.get_state(project="nvidia", catalog=catalog,
+                        resolve_digests=True) == state
+
+
+@pytest.fixture
+def ngc(monkeypatch):
+    monkeypatch.setattr(NGCRegistry, "_authenticate_for", lambda self, r: None)
+    responses = {
+        "org/nvidia/repos?include-teams=true&include-public=true": {
+            "repositories": [{"namespace": "nvidia", "name": "pytorch",
+                              "description": "# PyTorch"}]},
+        "org/nvidia/repos/pytorch/images": {"images": [
+            {"tag": "17.12", "updatedDate": "2017-12-04T05:56:41Z"},
+            {"tag": "17.11", "updatedDate": "2017-11-16T21:19:08Z"},
+        ]},
+    }
+    registry = NGCRegistry("api-key")
+    registry.default_org = "nvidia"
+    registry._get = lambda endpoint, revalidate=True: responses[endpoint]
+    digests = {"17.12": "sha256:d12"}
+
+    def get_digest(name, tag):
+        return digests[tag]
+    registry.v2.get_digest = get_digest
+    return registry
+
+
+def test_get_state_ngc_digests(ngc):
+    state = ngc.get_state(project="nvidia", resolve_digests=True,
+                          max_workers=2)
+    assert state["nvidia/pytorch"]["17.12"]["docker_id"] == "sha256:d12"
+    assert state["nvidia/pytorch"]["17.12"]["updated_date"] == \
+        "2017-12-04T05:56:41Z"
+    # unresolvable tags fall back to updatedDate
+    assert state["nvidia/pytorch"]["17.11"]["docker_id"] == \
+        "2017-11-16T21:19:08Z"
+    assert "digest" not in state["nvidia/pytorch"]["17.11"]
+
+
+def test_catalog_fingerprints(monkeypatch, tmpdir):
+    import json
+    repos = "org/nvidia/repos?include-teams=true&include-public=true"
+    responses = {
+        repos: {"repositories": [{"namespace": "nvidia", "name": "pytorch",
+                                  "latestTag": "17.12",
+                                  "updatedDate": "2017-12-04T05:56:41Z"}]},
+        "org/nvidia/repos/pytorch/images": {"images": [
+            {"tag": "17.12", "updatedDate": "2017-12-04T05:56:41Z"}]},
+    }
+    requested = []
+    digests = []
+
+    class Session:
+        def get(self, url, headers=None):
+            if "/token" in url:
+                return FakeResponse(url, {"token": "token"})
+            endpoint = url.split("/v2/", 1)[1]
+            requested.append(endpoint)
+            return FakeResponse(url, json.loads(json.dumps(
+                responses[endpoint])))
+
+    def get_digest(name, tag):
+        digests.append(tag)
+        return "sha256:d12"
+    monkeypatch.setattr(NGCRegistry, "_authenticate_for", lambda self, r: None)
+    ngc = NGCRegistry("api-key", session=Session(),
+                      cache=ResponseCache(str(tmpdir)))
+    ngc.default_org = "nvidia"
+    ngc.v2.get_digest = get_digest
+
+    catalog = ngc.snapshot()
+    first = ngc.get_state(catalog=catalog, resolve_digests=True)
+    fingerprints = json.loads(json.dumps(catalog.fingerprints()))
+    assert len(requested) == 2 and digests == ["17.12"]
+
+    # only fingerprints and digests are kept; tag listings stay in the cache
+    assert fingerprints == {"nvidia/pytorch": {
+        "fingerprint": "updatedDate=2017-12-04T05:56:41Z;latestTag=17.12",
+        "digests": {"17.12": ["2017-12-04T05:56:41Z", "sha256:d12"]}}}
+
+    # unchanged repositories are served from the previous run
+    del requested[:], digests[:]
+    catalog = ngc.snapshot(fingerprints=fingerprints)
+    assert catalog.changed() == set()
+    assert ngc.get_state(catalog=catalog, resolve_digests=True) == first
+    assert requested == [repos] and digests == []
+
+    # a new tag changes the fingerprint
+    del requested[:]
+    responses[repos]["repositories"][0]["latestTag"] = "18.01"
+    responses["org/nvidia/repos/pytorch/images"]["images"].append(
+        {"tag": "18.01", "updatedDate": "2018-01-04T05:56:41Z"})
+    catalog = ngc.snapshot(fingerprints=catalog.fingerprints())
+    assert catalog.changed(project="nvidia") == {"nvidia/pytorch"}
+    state = ngc.get_state(catalog=catalog, resolve_digests=True)
+    assert sorted(state["nvidia/pytorch"]) == ["17.12", "18.01"]
+    assert len(requested) == 2 and digests == ["18.01"]
+
+
+def test_token_manager_single_flight():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.05)
+        return "token-%d" % len(calls), 300
+
+    tokens = registry.TokenManager(fetch)
+    threads = [threading.Thread(target=tokens.get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    # a stale token does not invalidate the current one
+    tokens.invalidate("token-0")
+    assert tokens.get() == "token-1"
+    tokens.invalidate("token-1")
+    assert tokens.get() == "token-2"
+
+
+def test_token_manager_refreshes_before_expiry():
+    lifetimes = [0.2, 300]
+
+    def fetch():
+        return "token-%d" % len(lifetimes), lifetimes.pop(0)
+
+    tokens = registry.TokenManager(fetch, background=True)
+    assert tokens.get() == "token-2"
+    time.sleep(0.3)
+    assert tokens.get() == "token-1"
+    tokens.close()
+
+
+class FakeBlobRegistry:
+
+    def __init__(self, url, manifests=None, blobs=None):
+        self.url = url
+        self.manifests = manifests or {}
+        self.blobs = blobs or {}
+        self.uploaded = []
+        self.mounted = []
+
+    def get_raw_manifest(self, name, reference):
+        return self.manifests[(name, reference)]
+
+    def put_manifest(self, name, reference, content, media_type):
+        self.manifests[(name, reference)] = (content, media_type, None)
+
+    def blob_exists(self, name, digest):
+        return (name, digest) in self.blobs
+
+    def mount_blob(self, name, digest, from_name):
+        self.mounted.append((name, digest))
+        self.blobs[(name, digest)] = self.blobs[(from_name, digest)]
+        return True
+
+    def get_blob(self, name, digest):
+        data = self.blobs[(name, digest)]
+
+        class Response:
+            def iter_content(self, chunk_size):
+                for i in range(0, len(data), chunk_size):
+                    yield data[i:i + chunk_size]
+
+            def close(self):
+                pass
+        return Response()
+
+    def upload_blob(self, name, digest, data):
+        self.uploaded.append((name, digest))
+        self.blobs[(name, digest)] = b"".join(data)
+
+
+def test_image_copier():
+    import json
+    media_type = "application/vnd.docker.distribution.manifest.v2+json"
+
+    def manifest(*digests):
+        return json.dumps({
+            "config": {"digest": digests[0]},
+            "layers": [{"digest": digest} for digest in digests[1:]],
+        }).encode("utf-8")
+
+    source = FakeBlobRegistry("nvcr.io", manifests={
+        ("nvidia/cuda", "9.0"): (manifest("c1", "base", "l1"), media_type,
+                                 "sha256:cuda"),
+        ("nvidia/pytorch", "17.12"): (manifest("c2", "base", "l2"),
+                                      media_type, "sha256:pytorch"),
+    }, blobs={
+        ("nvidia/cuda", "c1"): b"c1", ("nvidia/cuda", "base"): b"base" * 10,
+        ("nvidia/cuda", "l1"): b"l1", ("nvidia/pytorch", "c2"): b"c2",
+        ("nvidia/pytorch", "base"): b"base" * 10,
+        ("nvidia/pytorch", "l2"): b"l2",
+    })
+    target = FakeBlobRegistry("registry:5000", blobs={
+        ("nvidia/cuda", "l1"): b"l1"})
+    copier = registry.ImageCopier(source, target, chunk_size=3)
+
+    assert copier.copy("nvidia/cuda", "9.0") == "sha256:cuda"
+    assert sorted(target.uploaded) == [("nvidia/cuda", "base"),
+                                       ("nvidia/cuda", "c1")]
+    assert target.blobs[("nvidia/cuda", "base")] == b"base" * 10
+    copier.copy("nvidia/pytorch", "17.12")
+    # the shared base layer is mounted rather than uploaded again
+    assert target.mounted == [("nvidia/pytorch", "base")]
+    assert target.manifests[("nvidia/pytorch", "17.12")][0] == \
+        source.manifests[("nvidia/pytorch", "17.12")][0]
+
+
+def test_oci_layout(tmpdir):
+    import hashlib
+    import json
+    media_type = "application/vnd.docker.distribution.manifest.v2+json"
+
+    def sha(data):
+        return "sha256:" + hashlib.sha256(data).hexdigest()
+
+    blobs = {name: name.encode("utf-8") * 3 for name in
+             ("cfg1", "cfg2", "base", "l1", "l2")}
+
+    def manifest(*names):
+        return json.dumps({
+            "config": {"digest": sha(blobs[names[0]])},
+            "layers": [{"digest": sha(blobs[name])} for name in names[1:]],
+        }).encode("utf-8")
+
+    manifests = {
+        ("nvidia/cuda", "9.0"): manifest("cfg1", "base", "l1"),
+        ("nvidia/cuda", "10.0"): manifest("cfg2", "base", "l2"),
+    }
+    source = FakeBlobRegistry("nvcr.io", manifests={
+        key: (value, media_type, sha(value))
+        for key, value in manifests.items()
+    }, blobs={("nvidia/cuda", sha(data)): data for data in blobs.values()})
+    layout = registry.OCILayout(str(tmpdir))
+    copier = registry.ImageCopier(source, layout)
+    copier.copy("nvidia/cuda", "9.0")
+    copier.copy("nvidia/cuda", "10.0")
+    copier.copy("nvidia/cuda", "9.0")
+
+    stored = os.listdir(str(tmpdir.join("blobs", "sha256")))
+    # 5 distinct blobs + 2 manifests; the shared base layer is stored once
+    assert len(stored) == 7
+    index = layout.index()
+    refs = {entry["annotations"]["org.opencontainers.image.ref.name"]:
+            entry["digest"] for entry in index["manifests"]}
+    assert refs == {
+        "nvidia/cuda:9.0": sha(manifests[("nvidia/cuda", "9.0")]),
+        "nvidia/cuda:10.0": sha(manifests[("nvidia/cuda", "10.0")]),
+    }
+    with pytest.raises(registry.RegistryError):
+        layout.upload_blob("nvidia/cuda", sha(b"x"), [b"y"])
+
+
+def test_write_stream(tmpdir):
+    import hashlib
+    from nvidia_deepops.docker.client.base import read_stream, write_stream
+    filename = str(tmpdir.join("docker_image_busybox:latest.tar"))
+    data = [b"a" * 10, b"b" * 10, b"c"]
+    digest = write_stream(iter(data), filename)
+    assert digest == hashlib.sha256(b"".join(data)).hexdigest()
+    assert list(read_stream(filename, chunk_size=8))[0] == b"a" * 8
+    assert b"".join(read_stream(filename, chunk_size=8)) == b"".join(data)
+    with open(filename + ".sha256") as file:
+        assert file.read() == \
+            "{}  docker_image_busybox:latest.tar\n".format(digest)
+
+    def failing():
+        yield b"x"
+        raise IOError("disk full")
+
+    with pytest.raises(IOError):
+        write_stream(failing(), filename)
+    assert not os.path.exists(filename + ".part")
+    assert b"".join(read_stream(filename)) == b"".join(data)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_compressed_tarfiles(tmpdir, compression):
+    import gzip
+    from nvidia_deepops.docker.client import base
+    client = DockerClient.__new__(DockerClient)
+    client.compression = compression
+    filename = client.url2filename("nvcr.io/nvidia/cuda:10.0")
+    assert filename.endswith(base.COMPRESSION_SUFFIXES[compression])
+    assert client.filename2url(filename) == "nvcr.io/nvidia/cuda:10.0"
+
+    data = [os.urandom(1024) * 64 for _ in range(8)]
+    command = base.compressor_command(compression, level=1, threads=2)
+    path = str(tmpdir.join(filename))
+    base.write_stream(
+        base.compress_stream(iter(data), command, chunk_size=4096), path)
+    assert os.path.getsize(path) < len(b"".join(data))
+    if compression == "gzip":
+        with gzip.open(path) as file:
+            assert file.read() == b"".join(data)
+    else:
+        assert b"".join(base.decompress_stream(path)) == b"".join(data)
+
+
 def test_client_lifecycle(nvcr, locr):
     client = FakeClient(registries=[nvcr, locr])
     # we should see an exception when the image is not in the registry
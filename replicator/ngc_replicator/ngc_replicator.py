@@ -3,130 +3,426 @@ import collections
 import json
 import logging
 import os
-import pprint
+import random
 import re
+import shutil
+import threading
 import time
 
 from concurrent import futures
 
 import click
-#import grpc
 import yaml
 
-from nvidia_deepops import Progress, utils
-from nvidia_deepops.docker import DockerClient, NGCRegistry, DGXRegistry
+from nvidia_deepops import Progress, session, utils
+from nvidia_deepops.cache import ResponseCache
+from nvidia_deepops.docker import (DockerClient, DockerRegistry, ImageCopier,
+                                   NGCRegistry, DGXRegistry, OCILayout,
+                                   url2filename)
 
 from . import replicator_pb2
-#from . import replicator_pb2_grpc
+from .pipeline import Finished, Pipeline, Stage
+from .service import ReplicatorService, serve
+from .state import StateStore, docker_id_of
 
 log = utils.get_logger(__name__, level=logging.INFO)
 
-_ONE_DAY_IN_SECONDS = 60 * 60 * 24
+
+def link_file(src, dst):
+    """
+    Makes `dst` a hard link to `src`, or a copy of it where the filesystem
+    cannot link.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class lazy_attribute:
+    """
+    Attribute computed by the decorated method on first access and kept on the
+    instance; computed once even when several pipeline workers first need it at
+    the same time.  Assigning the attribute replaces the computed value.
+    """
+
+    _lock = threading.RLock()
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.name = fn.__name__
+        self.__doc__ = fn.__doc__
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        with self._lock:
+            if self.name not in obj.__dict__:
+                obj.__dict__[self.name] = self.fn(obj)
+        return obj.__dict__[self.name]
+
+
+class PollInterval:
+    """
+    Delay between two polls of `--watch`, adapted to how often the catalog
+    changes: it grows by `factor` after every poll without a change, up to
+    `maximum` seconds, and drops back to `minimum` seconds after a change.
+    `jitter` spreads the polls of replicators started at the same time.
+    """
+
+    def __init__(self, minimum, maximum, factor=2.0, jitter=0.1):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.factor = factor
+        self.jitter = jitter
+        self.current = minimum
+
+    def next(self, changed):
+        if changed:
+            self.current = self.minimum
+        else:
+            self.current = min(self.maximum, self.current * self.factor)
+        return self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
 
 
 class Replicator:
+    """
+    Clones the images of an NGC (or DGX) project to tarfiles, singularity
+    images, an OCI layout and/or another registry.
+
+    Registry clients, docker clients and their logins are created on first use,
+    so a dry run or a run with nothing to clone only lists the catalog and
+    never contacts the docker daemon.
+    """
 
     def __init__(self, *, api_key, project, **optional_config):
         log.info("Initializing Replicator")
+        self._api_key = api_key
         self._config = optional_config
         self.project = project
         self.service = self.config("service")
-        if len(api_key) == 40:
-            self.nvcr = DGXRegistry(api_key)
-        else:
-            self.nvcr = NGCRegistry(api_key)
-        self.nvcr_client = DockerClient()
-        self.nvcr_client.login(username="$oauthtoken", password=api_key, registry="nvcr.io/v2")
-        self.registry_client = None
+        self.rate_limiter = None
+        if self.config("api_rate_limit"):
+            self.rate_limiter = session.RateLimiter(
+                self.config("api_rate_limit"),
+                burst=self.config("api_rate_burst"))
+        self.output_path = self.config("output_path") or "/output"
+        self.daemonless = self.config("daemonless")
+        self.export_format = self.config("export_format") or "docker"
+        self._external_registries = {}
         self.min_version = self.config("min_version")
         self.py_version = self.config("py_version")
         self.images = self.config("image") or []
-        self.progress = Progress(uri=self.config("progress_uri"))
-        if self.config("registry_url"):
-            self.registry_url = self.config("registry_url")
-            self.registry_client = DockerClient()
-            if self.config("registry_username") and self.config("registry_password"):
-                self.registry_client.login(username=self.config("registry_username"),
-                                           password=self.config("registry_password"),
-                                           registry=self.config("registry_url"))
-        self.output_path = self.config("output_path") or "/output"
-        self.state_path = os.path.join(self.output_path, "state.yml")
-        self.state = collections.defaultdict(dict)
-        if os.path.exists(self.state_path):
-            with open(self.state_path, "r") as file:
-                tmp = yaml.load(file, Loader=yaml.UnsafeLoader)
-            if tmp:
-                for key, val in tmp.items():
-                    self.state[key] = val
-        self.export_to_tarfile = self.config("exporter")
+        self.progress = Progress(
+            uri=self.config("progress_uri"),
+            session=self.http_session(pool_size=1, rate_limiter=False),
+            interval=self.config("progress_interval", 1.0),
+            timeout=self.config("progress_timeout", 10))
+        self.registry_url = self.config("registry_url")
+        if self.registry_url and self.daemonless:
+            log.info("images will be copied to {} without a docker daemon"
+                     .format(self.registry_url))
+        self.state_store = StateStore(self.output_path)
+        self.export_to_tarfile = self.config("exporter") and \
+            self.export_format == "docker"
         self.third_party_images = []
         if self.config("external_images"):
             self.third_party_images.extend(self.read_external_images_file())
         if self.export_to_tarfile:
             log.info("tarfiles will be saved to {}".format(self.output_path))
+        elif self.config("exporter") and self.export_format == "oci":
+            self.oci_path = os.path.join(self.output_path, "oci")
+            log.info("images will be saved to the OCI layout {}".format(
+                self.oci_path))
         self.export_to_singularity = self.config("singularity")
         if self.export_to_singularity:
-            log.info("singularity images will be saved to {}".format(self.output_path))
+            log.info("singularity images will be saved to {}".format(
+                self.output_path))
         log.info("Replicator initialization complete")
 
+    @property
+    def push_to_registry(self):
+        """
+        True when images are pushed to `registry_url` through the docker
+        daemon.
+        """
+        return bool(self.config("registry_url")) and \
+            not self.config("daemonless")
+
+    @lazy_attribute
+    def nvcr(self):
+        registry = DGXRegistry if len(self._api_key) == 40 else NGCRegistry
+        return registry(self._api_key, session=self.http_session(),
+                        cache=self.http_cache())
+
+    @lazy_attribute
+    def nvcr_client(self):
+        """Docker client pulling from nvcr.io, logged in on first use."""
+        client = DockerClient(
+            compression=self.config("export_compression"),
+            compression_level=self.config("export_compression_level"),
+            compression_threads=self.config("export_compression_threads") or 0)
+        client.login(username="$oauthtoken", password=self._api_key,
+                     registry="nvcr.io/v2")
+        return client
+
+    @lazy_attribute
+    def target_registry(self):
+        """
+        v2 API of `registry_url`, used for copies and manifest-only re-tags.
+        """
+        if not self.registry_url:
+            return None
+        return DockerRegistry(url=self.registry_url,
+                              username=self.config("registry_username"),
+                              password=self.config("registry_password"),
+                              session=self.http_session(rate_limiter=False))
+
+    @lazy_attribute
+    def registry_client(self):
+        """Docker client pushing to `registry_url`, logged in on first use."""
+        if not self.push_to_registry:
+            return None
+        client = DockerClient()
+        if self.config("registry_username") and \
+                self.config("registry_password"):
+            client.login(username=self.config("registry_username"),
+                         password=self.config("registry_password"),
+                         registry=self.config("registry_url"))
+        return client
+
+    @lazy_attribute
+    def copier(self):
+        if not (self.registry_url and self.daemonless):
+            return None
+        return ImageCopier(self.nvcr.v2, self.target_registry,
+                           max_workers=self.config("copy_concurrency") or 4)
+
+    @lazy_attribute
+    def oci_copier(self):
+        if not (self.config("exporter") and self.export_format == "oci"):
+            return None
+        return ImageCopier(self.nvcr.v2, OCILayout(self.oci_path),
+                           max_workers=self.config("copy_concurrency") or 4)
+
     def read_external_images_file(self):
         with open(self.config("external_images"), "r") as file:
             data = yaml.load(file, Loader=yaml.UnsafeLoader)
         images = data.get("images", [])
-        images = [replicator_pb2.DockerImage(name=image["name"], tag=image.get("tag", "latest")) for image in images]
+        images = [replicator_pb2.DockerImage(name=image["name"],
+                                             tag=image.get("tag", "latest"))
+                  for image in images]
         return images
 
+    @property
+    def state(self):
+        # loaded on first use; `images_to_download` does not need it until the
+        # remote is listed
+        return self.state_store.state
+
     def config(self, key, default=None):
         return self._config.get(key, default)
 
+    def http_session(self, pool_size=None, rate_limiter=True):
+        """
+        Returns a new connection-pooled HTTP session tuned by the `http_*`
+        options.  The pool is never smaller than `query_concurrency` so that
+        concurrent queries do not discard connections.  Registry sessions share
+        the `api_rate_limit` token bucket.
+        """
+        pool_size = pool_size or max(self.config("http_pool_size") or 10,
+                                     self.config("query_concurrency") or 1)
+        retry = session.RetryPolicy(retries=self.config("http_retries", 3),
+                                    backoff=self.config("http_backoff", 0.5))
+        return session.Session(
+            pool_size=pool_size,
+            keep_alive=self.config("http_keep_alive", True),
+            retry=retry,
+            rate_limiter=self.rate_limiter if rate_limiter else None)
+
+    def http_cache(self):
+        """
+        Returns the on-disk cache of registry API responses kept under
+        `output_path`, or None when disabled with `--no-http-cache`.
+        """
+        if not self.config("http_cache", True):
+            return None
+        max_size = (self.config("http_cache_size") or 256) * 1024 * 1024
+        return ResponseCache(
+            os.path.join(self.output_path, ".http_cache"),
+            max_size=max_size,
+            ttl=self.config("http_cache_ttl") or 7 * 24 * 60 * 60,
+            max_age=self.config("http_cache_max_age") or 0)
+
+    def source_registry(self, image_name, docker_id):
+        """
+        Returns the v2 registry serving `image_name` and the repository name on
+        it.  Images with a `docker_id` come from nvcr.io; external images are
+        resolved like `docker pull` resolves them, i.e. Docker Hub unless a
+        registry host is given.
+        """
+        if docker_id:
+            return self.nvcr.v2, image_name
+        host, _, path = image_name.partition("/")
+        if not path or not ("." in host or ":" in host or host == "localhost"):
+            host = "registry-1.docker.io"
+            path = image_name if "/" in image_name else "library/" + image_name
+        if host not in self._external_registries:
+            self._external_registries[host] = DockerRegistry(
+                url=host, verify_ssl=True,
+                session=self.http_session(rate_limiter=False))
+        return self._external_registries[host], path
+
     def save_state(self):
-        with open(self.state_path, "w") as file:
-            yaml.dump(self.state, file)
+        self.state_store.compact()
+
+    def snapshot(self):
+        """
+        Returns the catalog snapshot shared by every query of a replication
+        cycle; repositories unchanged since the last cycle are not listed
+        again.
+        """
+        return self.nvcr.snapshot(fingerprints=self.state_store.catalog)
 
     def sync(self, project=None):
         log.info("Replicator Started")
+        for _ in self.replicate(project=project):
+            pass
+        # progress is posted in the background; give the final update a chance
+        # to go out
+        self.progress.close(timeout=self.config("progress_timeout", 10))
+        log.info("Replicator finished")
+
+    def replicate(self, project=None, catalog=None, names=None):
+        """
+        Runs one replication cycle and yields each image as soon as it has been
+        cloned.  The image descriptions are written once every image is done.
+
+        :param catalog: snapshot of the catalog to replicate; a new one when
+            None
+        :param names: only replicate these repositories; every one when None
+        """
+        catalog = catalog or self.snapshot()
 
         # pull images
-        new_images = {image.name: image.tag for image in self.sync_images(project=project)}
+        new_images = {}
+        for image in self.sync_images(project=project, catalog=catalog,
+                                      names=names):
+            new_images[image.name] = image.tag
+            yield image
 
         # pull image descriptions - new_images should be empty for dry runs
         self.progress.update_step(key="markdown", status="running")
         self.update_progress()
-        descriptions = self.nvcr.get_image_descriptions(project=project)
+        descriptions = catalog.image_descriptions(project=project)
         for image_name, _ in new_images.items():
             markdown = os.path.join(self.output_path, "description_{}.md".format(image_name.replace('/', '%%')))
             with open(markdown, "w") as out:
                 out.write(descriptions.get(image_name, ""))
         self.progress.update_step(key="markdown", status="complete")
         self.update_progress()
-        log.info("Replicator finished")
 
-    def sync_images(self, project=None):
+    def watch(self, project=None):
+        """
+        Polls the catalog until interrupted and replicates new image:tags as
+        they appear.
+
+        The first poll replicates every missing image; later polls diff the
+        catalog against the previous poll and only replicate the repositories
+        whose fingerprint changed.  Repositories without a fingerprint, e.g.
+        those of a DGX registry, are caught up by a complete cycle at least
+        every `watch_max_interval`.  The delay between polls adapts to how
+        often the catalog changes, see `PollInterval`.  A failed cycle is
+        retried in full on the next poll.
+        """
         project = project or self.project
-        for image in self.images_to_download(project=project):
-            if self.config("dry_run"):
-                click.echo("[dry-run] clone_image({}, {}, {})".format(image.name, image.tag, image.docker_id))
-                continue
-            log.info("Pulling {}:{}".format(image.name, image.tag))
-            self.clone_image(image.name, image.tag, image.docker_id)  # independent
-            self.state[image.name][image.tag] = image.docker_id  # dep [clone]
+        maximum = self.config("watch_max_interval") or 60 * 60
+        interval = PollInterval(self.config("watch_min_interval") or 60,
+                                maximum)
+        complete = None
+        log.info("watching {} for new images".format(project))
+        try:
+            while True:
+                started = time.monotonic()
+                catalog = self.snapshot()
+                names = None
+                if complete is not None and started - complete < maximum:
+                    accepts = self.name_filter()
+                    names = {name for name in catalog.changed(project=project)
+                             if accepts is None or accepts(name=name)}
+                changed = names is None or bool(names)
+                if changed:
+                    log.info("replicating {}".format(
+                        "every missing image" if names is None
+                        else ", ".join(sorted(names))))
+                    self.progress.reset()
+                    try:
+                        cloned = sum(1 for _ in self.replicate(
+                            project=project, catalog=catalog, names=names))
+                        log.info("cloned {} images".format(cloned))
+                        if names is None:
+                            complete = started
+                    except Exception as err:
+                        log.error("replication failed; retrying every missing "
+                                  "image on the next poll: {}".format(err))
+                        complete = None
+                        changed = False
+                    self.progress.flush(
+                        timeout=self.config("progress_timeout", 10))
+                delay = interval.next(changed=changed)
+                log.info("next poll in {:.0f} sec".format(delay))
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            pass
+
+    def sync_images(self, project=None, catalog=None, names=None):
+        project = project or self.project
+        images = self.images_to_download(project=project, catalog=catalog,
+                                         names=names)
+        if self.config("dry_run"):
+            for image in images:
+                click.echo("[dry-run] clone_image({}, {}, {})".format(
+                    image.name, image.tag, image.docker_id))
+            images = []
+        # image N+1 is pulled while image N is exported; completed images
+        # arrive in order and are already committed, so that an interrupted
+        # run does not clone them again
+        for image, _ in self.clone_images(images):
             yield image
+        if catalog is not None:
+            self.state_store.catalog = catalog.fingerprints()
         self.save_state()
 
-    def images_to_download(self, project=None):
+    def images_to_download(self, project=None, catalog=None, names=None):
         project = project or self.project
 
-        self.progress.add_step(key="query", status="running", header="Getting list of Docker images to clone")
+        self.progress.add_step(key="query", status="running",
+                               header="Getting list of Docker images to clone")
         self.update_progress(progress_length_unknown=True)
 
-        # determine images and tags (and dockerImageIds) from the remote registry
-        if self.config("strict_name_match"):
-            filter_fn = self.filter_on_tag_strict if self.min_version or self.images else None
+        # determine images and tags (and dockerImageIds) from the remote
+        # registry; images are filtered on name before their tags are listed,
+        # then on version per tag
+        accepts = self.name_filter()
+        if names is None:
+            name_filter_fn = accepts
         else:
-            filter_fn = self.filter_on_tag if self.min_version or self.images else None
-        remote_state = self.nvcr.get_state(project=project, filter_fn=filter_fn)
-
-        # determine which images need to be fetch for the local state to match the remote
+            def name_filter_fn(*, name):
+                return name in names and (
+                    accepts is None or accepts(name=name))
+        filter_fn = None
+        if self.min_version or self.py_version:
+            filter_fn = self.filter_on_version
+        remote_state = self.nvcr.get_state(
+            project=project, filter_fn=filter_fn,
+            name_filter_fn=name_filter_fn, catalog=catalog,
+            resolve_digests=self.config("digests", True),
+            max_workers=self.config("query_concurrency"))
+
+        # determine which images need to be fetch for the local state to match
+        # the remote
         to_pull = self.missing_images(remote_state)
 
         # sort images into two buckets: cuda and not cuda
@@ -136,14 +432,22 @@ class Replicator:
         all_images = [image for image in self.images_from_state(cuda_images)]
         all_images.extend([image for image in self.images_from_state(other_images)])
 
-        if self.config("external_images"):
+        # external images have no catalog to diff against; they go with
+        # complete cycles
+        if self.config("external_images") and names is None:
             all_images.extend(self.third_party_images)
 
+        # sizes reported by the registry drive the byte-level progress of each
+        # transfer
         for image in all_images:
-            self.progress.add_step(key="{}:{}".format(image.name, image.tag),
-                                   header="Cloning {}:{}".format(image.name, image.tag),
+            key = "{}:{}".format(image.name, image.tag)
+            self.progress.add_step(key=key, header="Cloning {}".format(key),
                                    subHeader="Waiting to pull image")
-        self.progress.add_step(key="markdown", header="Downloading NVIDIA Deep Learning READMEs")
+            size = to_pull.get(image.name, {}).get(image.tag, {}).get("size")
+            for transfer in self.registry_transfers():
+                self.progress.expect(key, transfer, size)
+        self.progress.add_step(
+            key="markdown", header="Downloading NVIDIA Deep Learning READMEs")
         self.progress.update_step(key="query", status="complete")
         self.update_progress()
 
@@ -153,90 +457,349 @@ class Replicator:
         for image in self.images_from_state(other_images):
             yield image
 
-        if self.config("external_images"):
+        if self.config("external_images") and names is None:
             for image in self.third_party_images:
                 yield image
 
     def update_progress(self, progress_length_unknown=False):
         self.progress.post(progress_length_unknown=progress_length_unknown)
 
+    def registry_transfers(self):
+        """
+        Returns the transfers of each image that move its registry size: the
+        OCI export, the daemonless copy and the docker pull.  The tarfile save
+        is sized by the daemon once the image has been pulled.
+        """
+        transfers = []
+        if self.config("exporter") and self.export_format == "oci":
+            transfers.append("oci")
+        if self.registry_url and self.daemonless:
+            transfers.append("copy")
+        if self.pulls_image():
+            transfers.append("pull")
+        return transfers
+
+    def pulls_image(self):
+        """True when a destination is fed from the docker daemon."""
+        return bool(self.export_to_tarfile or self.export_to_singularity or
+                    self.push_to_registry)
+
+    def byte_progress(self, image, transfer):
+        """
+        Returns the callback through which `transfer` of `image` reports its
+        bytes.
+        """
+        key = "{}:{}".format(image.name, image.tag)
+        return lambda nbytes: self.progress.advance(key, nbytes, transfer)
+
     @staticmethod
     def images_from_state(state):
         for image_name, tag_data in state.items():
             for tag, docker_id in tag_data.items():
                 yield replicator_pb2.DockerImage(name=image_name, tag=tag, docker_id=docker_id.get("docker_id", ""))
 
-    def clone_image(self, image_name, tag, docker_id):
-        if docker_id:
-            url = self.nvcr.docker_url(image_name, tag=tag)
-        else:
-            url = "{}:{}".format(image_name, tag)
+    def image_url(self, image):
+        if image.docker_id:
+            return self.nvcr.docker_url(image.name, tag=image.tag)
+        return "{}:{}".format(image.name, image.tag)
+
+    def clone_stages(self):
+        """
+        Returns the steps of the clone `Pipeline`.
+
+        The first step acquires an image: it copies it to the OCI layout or to
+        the target registry without a docker daemon, and pulls it once when a
+        destination is fed from the docker daemon.  The tarfile export, the
+        singularity build and the registry push then run concurrently, each
+        with its own worker pool, and the local image is removed once all of
+        them have finished.
+        """
+        queue_size = self.config("pipeline_queue_size") or 1
+        consumers = []
         if self.export_to_tarfile:
-            tarfile = self.nvcr_client.url2filename(url)
-            if os.path.exists(tarfile):
-                log.warning("{} exists; removing and rebuilding".format(tarfile))
-                os.remove(tarfile)
-            log.info("cloning %s --> %s" % (url, tarfile))
-            self.progress.update_step(key="{}:{}".format(image_name, tag), status="running", subHeader="Pulling image from Registry")
-            self.update_progress()
-            self.nvcr_client.pull(url)
-            self.progress.update_step(key="{}:{}".format(image_name, tag), status="running", subHeader="Saving image to tarfile")
-            self.update_progress()
-            self.nvcr_client.save(url, path=self.output_path)
-            self.progress.update_step(key="{}:{}".format(image_name, tag), status="complete", subHeader="Saved {}".format(tarfile))
-            log.info("Saved image: %s --> %s" % (url, tarfile))
+            consumers.append(Stage("export", self.export_tarfile,
+                                   queue_size=queue_size,
+                                   workers=self.config("export_workers")))
         if self.export_to_singularity:
-            sif = os.path.join(self.output_path, "{}.sif".format(url).replace("/", "_"))
-            if os.path.exists(sif):
-                log.warning("{} exists; removing and rebuilding".format(sif))
-                os.remove(sif)
-            log.info("cloning %s --> %s" % (url, sif))
-            self.progress.update_step(key="{}:{}".format(image_name, tag), status="running", subHeader="Pulling image from Registry")
-            self.update_progress()
-            self.nvcr_client.pull(url)
-            self.progress.update_step(key="{}:{}".format(image_name, tag), status="running", subHeader="Saving image to singularity image file")
+            consumers.append(Stage("singularity", self.export_singularity,
+                                   queue_size=queue_size,
+                                   workers=self.config("singularity_workers")))
+        if self.push_to_registry:
+            consumers.append(Stage("push", self.push_image,
+                                   queue_size=queue_size,
+                                   workers=self.config("push_workers")))
+        steps = [Stage("pull", self.acquire_image, queue_size=queue_size,
+                       workers=self.config("pull_workers"))]
+        if consumers:
+            steps.append(consumers)
+            steps.append(Stage("remove", self.release_image, always=True))
+        return steps
+
+    def clone_images(self, images):
+        """
+        Runs `images` through the clone pipeline and yields each image with the
+        entry recorded for it in the replicator state, in the order of
+        `images`.  The first failure is raised once the images already in
+        flight have finished.
+
+        Each image is committed to the state as soon as its clone has finished,
+        so images that finished behind a slow or failed one are not cloned
+        again by the next run.
+        """
+        pipeline = Pipeline(self.clone_stages(), on_finish=self.commit_job)
+        jobs = pipeline.run(images)
+        try:
+            for job in jobs:
+                image = job.item
+                key = "{}:{}".format(image.name, image.tag)
+                if job.error:
+                    self.progress.update_step(key=key, status="error",
+                                              subHeader=str(job.error))
+                    self.update_progress()
+                    raise job.error
+                self.progress.update_step(key=key, status="complete")
+                self.update_progress()
+                yield image, job.results["pull"]
+        finally:
+            jobs.close()
+
+    def commit_job(self, job):
+        if job.error is None:
+            image = job.item
+            self.state_store.commit(image.name, image.tag, job.results["pull"])
+
+    def clone_image(self, image_name, tag, docker_id):
+        """
+        Replicates `image_name:tag` to every configured destination and returns
+        the entry recorded for it in the replicator state.
+        """
+        image = replicator_pb2.DockerImage(name=image_name, tag=tag,
+                                           docker_id=docker_id)
+        for _, entry in self.clone_images([image]):
+            return entry
+
+    def acquire_image(self, image):
+        entry = {"docker_id": image.docker_id}
+        if self.oci_copier:
+            # blobs already in the layout are skipped, so a re-tag only stores
+            # the manifest
+            entry["oci"] = self.export_oci(image)
+        for tag in self.state_store.tags_of(image.name, image.docker_id):
+            if tag != image.tag and self.retag_image(image, tag):
+                return Finished(entry)
+        log.info("Pulling {}:{}".format(image.name, image.tag))
+        if self.copier:
+            self.copy_image(image)
+        if self.pulls_image():
+            key = "{}:{}".format(image.name, image.tag)
+            self.progress.update_step(key=key, status="running",
+                                      subHeader="Pulling image from Registry")
             self.update_progress()
-            utils.execute("singularity build {} docker-daemon://{}".format(sif, url))
-            self.progress.update_step(key="{}:{}".format(image_name, tag), status="complete", subHeader="Saved {}".format(sif))
-            log.info("Saved image: %s --> %s" % (url, sif))
-        if self.registry_client:
-            push_url = "{}/{}:{}".format(self.registry_url, image_name, tag)
-            self.nvcr_client.pull(url)
-            self.registry_client.tag(url, push_url)
-            self.registry_client.push(push_url)
-            self.registry_client.remove(push_url)
-        if not self.config("no_remove") and not image_name.endswith("cuda") and self.nvcr_client.get(url=url):
+            self.nvcr_client.pull(self.image_url(image),
+                                  progress=self.byte_progress(image, "pull"))
+        return entry
+
+    def retag_image(self, image, tag):
+        """
+        Satisfies `image` from the artifacts already cloned for
+        `image.name:tag`, which has the same content: tarfiles and singularity
+        images are hard linked and the target registry gets a manifest-only
+        re-tag.  Returns False, and changes nothing, when any of those
+        artifacts is missing.
+        """
+        known = replicator_pb2.DockerImage(name=image.name, tag=tag,
+                                           docker_id=image.docker_id)
+        links = []
+        if self.export_to_tarfile:
+            links.append((self.tarfile_path(known), self.tarfile_path(image)))
+        if self.export_to_singularity:
+            links.append((self.sif_path(known), self.sif_path(image)))
+        if not all(os.path.exists(src) for src, _ in links):
+            return False
+        manifest = None
+        if self.target_registry:
+            try:
+                manifest = self.target_registry.get_raw_manifest(image.name,
+                                                                 tag)
+            except Exception as err:
+                log.debug("cannot re-tag {}:{} in {}: {}".format(
+                    image.name, tag, self.registry_url, err))
+                return False
+        for src, dst in links:
+            link_file(src, dst)
+            if os.path.exists(src + ".sha256"):
+                with open(src + ".sha256") as file:
+                    digest = file.read().split()[0]
+                with open(dst + ".sha256", "w") as file:
+                    file.write("{}  {}\n".format(digest,
+                                                 os.path.basename(dst)))
+        if manifest:
+            content, media_type, _ = manifest
+            self.target_registry.put_manifest(image.name, image.tag, content,
+                                              media_type)
+        log.info("{}:{} has the content of {}:{}; re-tagged without pulling"
+                 .format(image.name, image.tag, image.name, tag))
+        return True
+
+    def tarfile_path(self, image):
+        filename = url2filename(self.image_url(image),
+                                self.config("export_compression"))
+        return os.path.join(self.output_path, filename)
+
+    def sif_path(self, image):
+        filename = "{}.sif".format(self.image_url(image)).replace("/", "_")
+        return os.path.join(self.output_path, filename)
+
+    def release_image(self, image):
+        url = self.image_url(image)
+        if not self.config("no_remove") and \
+                not image.name.endswith("cuda") and \
+                self.nvcr_client.get(url=url):
             try:
                 self.nvcr_client.remove(url)
             except:
                 log.warning("tried to remove docker image {}, but unexpectedly failed".format(url))
-        return image_name, tag, docker_id
+
+    def export_tarfile(self, image):
+        url = self.image_url(image)
+        key = "{}:{}".format(image.name, image.tag)
+        tarfile = self.tarfile_path(image)
+        if os.path.exists(tarfile):
+            log.warning("{} exists; removing and rebuilding".format(tarfile))
+            os.remove(tarfile)
+        log.info("cloning %s --> %s" % (url, tarfile))
+        self.progress.update_step(key=key, status="running",
+                                  subHeader="Saving image to tarfile")
+        self.progress.expect(key, "save", self.nvcr_client.image_size(url))
+        self.update_progress()
+        self.nvcr_client.save(url, path=self.output_path,
+                              progress=self.byte_progress(image, "save"))
+        self.progress.update_step(key=key, status="running",
+                                  subHeader="Saved {}".format(tarfile))
+        log.info("Saved image: %s --> %s" % (url, tarfile))
+
+    def export_singularity(self, image):
+        url = self.image_url(image)
+        key = "{}:{}".format(image.name, image.tag)
+        sif = self.sif_path(image)
+        if os.path.exists(sif):
+            log.warning("{} exists; removing and rebuilding".format(sif))
+            os.remove(sif)
+        log.info("cloning %s --> %s" % (url, sif))
+        self.progress.update_step(
+            key=key, status="running",
+            subHeader="Saving image to singularity image file")
+        self.update_progress()
+        utils.execute("singularity build {} docker-daemon://{}".format(sif,
+                                                                       url))
+        self.progress.update_step(key=key, status="running",
+                                  subHeader="Saved {}".format(sif))
+        log.info("Saved image: %s --> %s" % (url, sif))
+
+    def push_image(self, image):
+        url = self.image_url(image)
+        push_url = "{}/{}:{}".format(self.registry_url, image.name, image.tag)
+        self.registry_client.tag(url, push_url)
+        self.registry_client.push(push_url)
+        self.registry_client.remove(push_url)
+        log.info("Pushed image: %s --> %s" % (url, push_url))
+
+    def export_oci(self, image):
+        source, source_name = self.source_registry(image.name, image.docker_id)
+        ref = "{}:{}".format(image.name, image.tag)
+        self.progress.update_step(key=ref, status="running",
+                                  subHeader="Saving image to OCI layout")
+        self.update_progress()
+        digest = self.oci_copier.copy(
+            source_name, image.tag, target_name=image.name, source=source,
+            progress=self.byte_progress(image, "oci"))
+        self.progress.update_step(
+            key=ref, status="running",
+            subHeader="Saved to {}".format(self.oci_path))
+        log.info("Saved image: %s --> %s (%s)" % (ref, self.oci_path, digest))
+        return {"ref": ref, "digest": digest}
+
+    def copy_image(self, image):
+        source, source_name = self.source_registry(image.name, image.docker_id)
+        key = "{}:{}".format(image.name, image.tag)
+        self.progress.update_step(
+            key=key, status="running",
+            subHeader="Copying image to {}".format(self.registry_url))
+        self.update_progress()
+        self.copier.copy(source_name, image.tag, target_name=image.name,
+                         source=source,
+                         progress=self.byte_progress(image, "copy"))
+        self.progress.update_step(
+            key=key, status="running",
+            subHeader="Copied to {}".format(self.registry_url))
+        log.info("Copied image: %s --> %s/%s" % (key, self.registry_url, key))
 
     def filter_on_tag(self, *, name, tag, docker_id, strict_name_match=False):
         """
-        Filter function used by the `nvidia_deepops` library for selecting images.
+        Filter function used by the `nvidia_deepops` library for selecting
+        images.
+
+        Return True if the name/tag/docker_id combo should be included for
+        consideration.  Return False and the image will be excluded from
+        consideration, i.e. not cloned/replicated.
+        """
+        if not self.filter_on_name(name=name,
+                                   strict_name_match=strict_name_match):
+            return False
+        # if you are here, you have passed the name test
+        return self.filter_on_version(name=name, tag=tag, docker_id=docker_id)
+
+    def filter_on_tag_strict(self, *, name, tag, docker_id):
+        return self.filter_on_tag(name=name, tag=tag, docker_id=docker_id,
+                                  strict_name_match=True)
+
+    def name_filter(self):
+        """Returns the name-level filter selected by `--image`, or None."""
+        if not self.images:
+            return None
+        if self.config("strict_name_match"):
+            return self.filter_on_name_strict
+        return self.filter_on_name
+
+    def filter_on_name(self, *, name, strict_name_match=False):
+        """
+        Name-level filter; return False if no tag of image `name` should ever
+        be replicated.
 
-        Return True if the name/tag/docker_id combo should be included for consideration.
-        Return False and the image will be excluded from consideration, i.e. not cloned/replicated.
+        This is passed to `get_state` as `name_filter_fn` so that tags are only
+        listed for images that can match.
         """
         if self.images:
-            log.debug("filtering on images name, only allow {}".format(self.images))
+            log.debug("filtering on images name, only allow %s", self.images)
             found = False
             for image in self.images:
                 if (not strict_name_match) and (image in name):
-                    log.debug("{} passes filter; matches {}".format(name, image))
+                    log.debug("%s passes filter; matches %s", name, image)
                     found = True
-                elif (strict_name_match) and image.strip() == (name.split('/')[-1]).strip():
-                    log.debug("{} passes strict filter; matches {}".format(name, image))
+                elif (strict_name_match) and \
+                        image.strip() == (name.split('/')[-1]).strip():
+                    log.debug("%s passes strict filter; matches %s", name,
+                              image)
                     found = True
             if not found:
-                log.debug("{} fails filter by image name".format(name))
+                log.debug("%s fails filter by image name", name)
                 return False
-        # if you are here, you have passed the name test
-        # now, we check the version of the container by trying to extract the YY.MM details from the tag
+        return True
+
+    def filter_on_name_strict(self, *, name):
+        return self.filter_on_name(name=name, strict_name_match=True)
+
+    def filter_on_version(self, *, name, tag, docker_id):
+        """
+        Tag-level filter; checks the `py_version` and `min_version` of a single
+        tag.
+        """
+        # we check the version of the container by trying to extract the YY.MM
+        # details from the tag
         if self.py_version:
             if tag.find(self.py_version) == -1:
-                log.debug("tag {} fails py_version {} filter".format(tag, self.py_version))
+                log.debug("tag %s fails py_version %s filter", tag,
+                          self.py_version)
                 return False
         version_regex = re.compile(r"^(\d\d\.\d\d)")
         float_tag = version_regex.findall(tag)
@@ -253,9 +816,6 @@ class Replicator:
         # if you are here, you have passed the tag test
         return True
 
-    def filter_on_tag_strict(self, *, name, tag, docker_id):
-        return self.filter_on_tag(name=name, tag=tag, docker_id=docker_id, strict_name_match=True)
-
     def missing_images(self, remote):
         """
         Generates a dict of dicts on a symmetric difference between remote/local which also includes
@@ -274,56 +834,52 @@ class Replicator:
 
         # log.debug("remote image names: %s" % remote.keys())
         # log.debug("local  image names: %s" % local.keys())
-        log.debug("image names not present: %s" % to_pull.keys())
+        log.debug("image names not present: %s",
+                  utils.lazy(list, to_pull.keys()))
 
         # determine which tags are not present
         for image_name, tag_data in remote.items():
             tags = set(tag_data.keys()) - set(local[image_name].keys())
             # log.debug("remote %s tags: %s" % (image_name, tag_data.keys()))
             # log.debug("local  %s tags: %s" % (image_name, local[image_name].keys()))
-            log.debug("tags not present for image {}: {}".format(image_name, tags))
+            log.debug("tags not present for image %s: %s", image_name, tags)
             for tag in tags:
                 to_pull[image_name][tag] = remote[image_name][tag]
 
         # determine if any name/tag pairs have a different dockerImageId than previously seen
         # this handles the cases where someone push a new images and overwrites a name:tag image
         for image_name, tag_data in remote.items():
-            if image_name not in local: continue
+            if image_name not in local:
+                continue
             for tag, docker_id in tag_data.items():
-                if tag not in local[image_name]: continue
-                if docker_id.get("docker_id") != local[image_name][tag]:
-                    log.debug("%s:%s changed on server" % (image_name, tag))
-                    to_pull[image_name][tag] = docker_id
-
-        log.info("images to be fetched: %s" % pprint.pformat(to_pull, indent=4))
+                if tag not in local[image_name]:
+                    continue
+                local_id = docker_id_of(local[image_name][tag])
+                if docker_id.get("docker_id") == local_id:
+                    continue
+                if docker_id.get("digest") and \
+                        docker_id.get("updated_date") == local_id:
+                    # state recorded before digests were resolved; the tag has
+                    # not been touched since, so adopt its digest instead of
+                    # pulling the same content again
+                    log.debug("%s:%s recorded by date; now tracked by digest",
+                              image_name, tag)
+                    entry = local[image_name][tag]
+                    if isinstance(entry, dict):
+                        entry = dict(entry, docker_id=docker_id["digest"])
+                    else:
+                        entry = docker_id["digest"]
+                    self.state_store.commit(image_name, tag, entry)
+                    continue
+                log.debug("%s:%s changed on server", image_name, tag)
+                to_pull[image_name][tag] = docker_id
+
+        log.info("images to be fetched: %d tags of %d images",
+                 sum(len(tags) for tags in to_pull.values()), len(to_pull))
+        log.debug("images to be fetched: %s", utils.lazy_pformat(to_pull))
         return to_pull
 
 
-## class ReplicatorService(replicator_pb2_grpc.ReplicatorServicer):
-## 
-##     def __init__(self, *, replicator):
-##         self.replicator = replicator
-##         self.replicator.service = True
-## 
-##     def StartReplication(self, request, context):
-##         project = request.org_name or self.replicator.project
-##         for image in self.replicator.sync_images(project=project):
-##             yield image
-## 
-##     def ListImages(self, request, context):
-##         project = request.org_name or self.replicator.project
-##         for image in self.replicator.images_to_download(project=project):
-##             yield image
-## #       images_and_tags = self.replicator.nvcr.get_images_and_tags(project=project)
-## #       for image_name, tags in images_and_tags.items():
-## #           for tag in tags:
-## #               yield replicator_pb2.DockerImage(name=image_name, tag=tag)
-## 
-##     def DownloadedImages(self, request, context):
-##         for images in self.replicator.images_from_state(self.replicator.state):
-##             yield images
-
-
 @click.command()
 @click.option("--api-key", envvar="NGC_REPLICATOR_API_KEY")
 @click.option("--project", default="nvidia")
@@ -331,15 +887,88 @@ class Replicator:
 @click.option("--min-version")
 @click.option("--py-version")
 @click.option("--image", multiple=True)
+@click.option("--query-concurrency", type=int, default=1,
+              help="Number of concurrent tag listing requests while querying "
+                   "the registry")
+@click.option("--http-pool-size", type=int, default=10,
+              help="Maximum number of pooled connections per host")
+@click.option("--http-keep-alive/--no-http-keep-alive", default=True)
+@click.option("--http-retries", type=int, default=3,
+              help="Number of times a failed or throttled request is retried")
+@click.option("--http-backoff", type=float, default=0.5,
+              help="Base delay in seconds of the jittered exponential backoff "
+                   "between retries")
+@click.option("--api-rate-limit", type=float,
+              help="Maximum average number of registry API requests per "
+                   "second")
+@click.option("--api-rate-burst", type=int,
+              help="Number of registry API requests allowed in a burst above "
+                   "the rate limit")
+@click.option("--http-cache/--no-http-cache", default=True,
+              help="Cache registry API responses under the output path")
+@click.option("--http-cache-size", type=int, default=256,
+              help="Maximum size of the response cache in MiB")
+@click.option("--http-cache-ttl", type=int, default=7 * 24 * 60 * 60,
+              help="Seconds before an unused cached response is evicted")
+@click.option("--http-cache-max-age", type=int, default=0,
+              help="Seconds a cached response is reused without revalidation")
+@click.option("--digests/--no-digests", default=True,
+              help="Detect changed NGC images by manifest digest rather than "
+                   "update date")
 @click.option("--registry-url")
 @click.option("--registry-username")
 @click.option("--registry-password")
+@click.option("--daemonless/--no-daemonless", default=False,
+              help="Copy images to --registry-url over HTTP instead of "
+                   "through the docker daemon")
+@click.option("--copy-concurrency", type=int, default=4,
+              help="Number of layers copied concurrently per image with "
+                   "--daemonless")
+@click.option("--pull-workers", type=int, default=1,
+              help="Number of images pulled or copied concurrently")
+@click.option("--export-workers", type=int, default=1,
+              help="Number of images saved to tarfiles concurrently")
+@click.option("--singularity-workers", type=int, default=1,
+              help="Number of singularity images built concurrently")
+@click.option("--push-workers", type=int, default=1,
+              help="Number of images pushed to --registry-url concurrently")
+@click.option("--pipeline-queue-size", type=int, default=1,
+              help="Number of images waiting in front of each stage")
 @click.option("--dry-run", is_flag=True)
-@click.option("--service", is_flag=True)
+@click.option("--service", is_flag=True,
+              help="Serve the replicator API over HTTP instead of running "
+                   "once")
+@click.option("--service-host", default="0.0.0.0",
+              help="Address the --service API listens on")
+@click.option("--service-port", type=int, default=50051,
+              help="Port the --service API listens on")
+@click.option("--watch", is_flag=True,
+              help="Keep polling the catalog and replicate new images as they "
+                   "are released")
+@click.option("--watch-min-interval", type=int, default=60,
+              help="Seconds between two polls of --watch right after a change")
+@click.option("--watch-max-interval", type=int, default=60 * 60,
+              help="Longest delay between two polls of --watch while nothing "
+                   "changes")
 @click.option("--external-images")
 @click.option("--progress-uri")
+@click.option("--progress-interval", type=float, default=1.0,
+              help="Minimum seconds between two posts to --progress-uri")
+@click.option("--progress-timeout", type=float, default=10,
+              help="Seconds before a post to --progress-uri is abandoned")
 @click.option("--no-remove", is_flag=True)
 @click.option("--exporter/--no-exporter", default=True)
+@click.option("--export-format", type=click.Choice(["docker", "oci"]),
+              default="docker",
+              help="Save images as one docker tarfile per tag, or into a "
+                   "shared OCI image layout")
+@click.option("--export-compression", type=click.Choice(["gzip", "zstd"]),
+              help="Compress saved tarfiles to .tar.gz (pigz) or .tar.zst "
+                   "(zstd)")
+@click.option("--export-compression-level", type=int,
+              help="Compression level; defaults to that of the compressor")
+@click.option("--export-compression-threads", type=int, default=0,
+              help="Compressor threads; 0 uses every core")
 @click.option("--templater/--no-templater", default=False)
 @click.option("--singularity/--no-singularity", default=False)
 @click.option("--strict-name-match/--no-strict-name-match", default=False)
@@ -354,19 +983,15 @@ def main(**config):
     replicator = Replicator(**config)
 
     if replicator.service:
-#       server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-#       replicator_pb2_grpc.add_ReplicatorServicer_to_server(
-#           ReplicatorService(replicator=replicator), server
-#       )
-#       server.add_insecure_port('[::]:50051')
-#       log.info("starting GRPC service on port 50051")
-#       server.start()
-#       try:
-#           while True:
-#               time.sleep(_ONE_DAY_IN_SECONDS)
-#       except KeyboardInterrupt:
-#           server.stop(0)
-        raise NotImplementedError("GPRC Service has been depreciated")
+        serve(ReplicatorService(replicator=replicator),
+              host=replicator.config("service_host") or "0.0.0.0",
+              port=replicator.config("service_port") or 50051)
+        replicator.progress.close(
+            timeout=replicator.config("progress_timeout", 10))
+    elif replicator.config("watch"):
+        replicator.watch()
+        replicator.progress.close(
+            timeout=replicator.config("progress_timeout", 10))
     else:
         replicator.sync()
 
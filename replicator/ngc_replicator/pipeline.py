@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+
+from nvidia_deepops import utils
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+_STOP = object()
+
+
+class Finished:
+    """
+    Returned by a stage function to record `value` as the stage's result and
+    skip all remaining stages of the item, including those marked `always`.
+    """
+
+    def __init__(self, value=None):
+        self.value = value
+
+
+class Stage:
+    """
+    One step of a `Pipeline`: `fn(item)` run by `workers` threads fed from a
+    queue holding at most `queue_size` items.
+
+    :param str name: key of the stage's return value in `Job.results`
+    :param bool always: run even when an earlier stage of the item failed,
+        e.g. cleanup
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=1, always=False):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers or 1)
+        self.queue = queue.Queue(maxsize=max(1, queue_size or 1))
+        self.always = always
+
+
+class Job:
+    """
+    An item travelling through a `Pipeline` with the results of its stages.
+    """
+
+    def __init__(self, index, item):
+        self.index = index
+        self.item = item
+        self.results = {}
+        self.error = None
+        self.finished = False
+        self.step = -1
+        self.pending = 0
+        self.done = threading.Event()
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of steps, each made of one or more stages
+    with their own worker pool and bounded queue.
+
+    Stages of the same step run concurrently on an item, and the item moves on
+    to the next step once all of them have finished, so that item N+1 can be in
+    the first step while item N is in the second.  The bounded queues apply
+    back pressure to the input iterator.  When a stage raises, the item skips
+    the remaining stages except those marked `always` and carries the first
+    exception in `Job.error`.  A stage returning `Finished` completes the item
+    early without running any other stage.
+
+    :param steps: list of `Stage`s or lists of `Stage`s
+    :param on_finish: called with each `Job` as soon as it has finished,
+        whatever the order of the input; an exception it raises becomes the
+        job's error
+    """
+
+    def __init__(self, steps, on_finish=None):
+        self.steps = [list(step) if isinstance(step, (list, tuple)) else [step]
+                      for step in steps]
+        self.steps = [step for step in self.steps if step]
+        self.on_finish = on_finish
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        """
+        Feeds `items` into the pipeline and yields a finished `Job` for each of
+        them, in input order.  Errors raised by the `items` iterator itself are
+        re-raised once every item it produced has been yielded.
+        """
+        jobs = []
+        feed_error = []
+        stopping = threading.Event()
+        changed = threading.Condition()
+        fed = threading.Event()
+
+        def feed():
+            try:
+                for index, item in enumerate(items):
+                    if stopping.is_set():
+                        break
+                    job = Job(index, item)
+                    with changed:
+                        jobs.append(job)
+                        changed.notify_all()
+                    self._advance(job)
+            except BaseException as err:
+                feed_error.append(err)
+            finally:
+                with changed:
+                    fed.set()
+                    changed.notify_all()
+
+        threads = [threading.Thread(target=self._work, args=(stage,),
+                                    daemon=True)
+                   for step in self.steps for stage in step
+                   for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            index = 0
+            while True:
+                with changed:
+                    while index >= len(jobs) and not fed.is_set():
+                        changed.wait()
+                    if index >= len(jobs):
+                        break
+                    job = jobs[index]
+                job.done.wait()
+                index += 1
+                yield job
+        finally:
+            stopping.set()
+            feeder.join()
+            for job in jobs:
+                job.done.wait()
+            for step in self.steps:
+                for stage in step:
+                    for _ in range(stage.workers):
+                        stage.queue.put(_STOP)
+            for thread in threads:
+                thread.join()
+        if feed_error:
+            raise feed_error[0]
+
+    def _advance(self, job):
+        # move `job` to the next step that has something to run, or finish it
+        while True:
+            job.step += 1
+            if job.step >= len(self.steps):
+                self._finish(job)
+                return
+            if job.finished:
+                continue
+            stages = [stage for stage in self.steps[job.step]
+                      if job.error is None or stage.always]
+            if stages:
+                break
+        job.pending = len(stages)
+        for stage in stages:
+            stage.queue.put(job)
+
+    def _finish(self, job):
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as err:
+                log.debug("finishing item {} failed: {}".format(
+                    job.index, err))
+                with self._lock:
+                    job.error = job.error or err
+        job.done.set()
+
+    def _work(self, stage):
+        while True:
+            job = stage.queue.get()
+            if job is _STOP:
+                return
+            try:
+                result = stage.fn(job.item)
+                if isinstance(result, Finished):
+                    job.finished = True
+                    result = result.value
+                job.results[stage.name] = result
+            except Exception as err:
+                log.debug("stage {} failed on item {}: {}".format(
+                    stage.name, job.index, err))
+                with self._lock:
+                    job.error = job.error or err
+            with self._lock:
+                job.pending -= 1
+                finished = job.pending == 0
+            if finished:
+                self._advance(job)
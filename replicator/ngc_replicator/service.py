@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import http.server
+import json
+import logging
+import threading
+
+from google.protobuf import json_format
+
+from nvidia_deepops import utils
+
+from . import replicator_pb2
+from .state import docker_id_of
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+__all__ = ('ReplicatorService', 'ServiceBusy', 'make_server', 'serve')
+
+
+class ServiceBusy(RuntimeError):
+    pass
+
+
+class ReplicatorService:
+    """
+    The `Replicator` service of `replicator.proto` on top of a resident
+    `Replicator`.
+
+    The replicator outlives each replication cycle, so its bearer token, pooled
+    connections, response cache, catalog fingerprints and in-memory state are
+    reused by the next cycle instead of being rebuilt by a cold start.  One
+    cycle runs at a time; the filters of a `Request` apply to its cycle only.
+
+    Methods take `(request, context)` like a gRPC servicer and yield the
+    messages of their response stream.
+    """
+
+    def __init__(self, *, replicator):
+        self.replicator = replicator
+        self.replicator.service = True
+        # reentrant, so that a cycle reserved by the HTTP handler runs in its
+        # thread
+        self._cycle = threading.RLock()
+
+    def reserve(self):
+        """
+        Takes the cycle lock for the calling thread without waiting; returns
+        False when another thread is running a cycle.  Undone by `release`.
+        """
+        return self._cycle.acquire(blocking=False)
+
+    def release(self):
+        self._cycle.release()
+
+    @contextlib.contextmanager
+    def cycle(self, request):
+        if not self.reserve():
+            raise ServiceBusy("a replication cycle is already running")
+        replicator = self.replicator
+        saved = replicator.min_version, replicator.images
+        try:
+            if request.min_version:
+                replicator.min_version = request.min_version
+            if request.images:
+                replicator.images = list(request.images)
+            replicator.progress.reset()
+            yield request.org_name or replicator.project
+        finally:
+            replicator.min_version, replicator.images = saved
+            self.release()
+
+    def StartReplication(self, request, context=None):
+        """
+        Runs a replication cycle, streaming each image once it has been cloned.
+        """
+        with self.cycle(request) as project:
+            log.info("replication of {} started".format(project))
+            for image in self.replicator.replicate(project=project):
+                yield image
+            timeout = self.replicator.config("progress_timeout", 10)
+            self.replicator.progress.flush(timeout=timeout)
+            log.info("replication of {} finished".format(project))
+
+    def ListImages(self, request, context=None):
+        """Streams the images the next replication cycle would clone."""
+        with self.cycle(request) as project:
+            catalog = self.replicator.snapshot()
+            for image in self.replicator.images_to_download(project=project,
+                                                            catalog=catalog):
+                yield image
+
+    def DownloadedImages(self, request, context=None):
+        """Streams the images recorded in the replicator state."""
+        prefix = request.org_name + "/" if request.org_name else ""
+        for name, tags in sorted(self.replicator.state_store.copy().items()):
+            if not name.startswith(prefix):
+                continue
+            for tag, entry in sorted(tags.items()):
+                yield replicator_pb2.DockerImage(
+                    name=name, tag=tag, docker_id=docker_id_of(entry) or "")
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the methods of `ReplicatorService` at `POST /Replicator/<method>`,
+    the paths gRPC uses.  The body is the JSON form of a `Request`, and the
+    response stream is sent as chunked newline-delimited JSON, one message per
+    line, written as soon as each message is produced.  An error after the
+    stream has started is reported on a last `{"error": ...}` line.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        service = self.server.service
+        method = self.path.rstrip("/")
+        rpc = {
+            "/Replicator/StartReplication": service.StartReplication,
+            "/Replicator/ListImages": service.ListImages,
+            "/Replicator/DownloadedImages": service.DownloadedImages,
+        }.get(method)
+        if rpc is None:
+            self.send_error(404, "unknown method {}".format(method))
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            request = json_format.Parse(body or b"{}",
+                                        replicator_pb2.Request())
+        except json_format.ParseError as err:
+            self.send_error(400, str(err))
+            return
+        # the cycle is reserved before the headers go out, so a busy service
+        # answers 409
+        exclusive = rpc != service.DownloadedImages
+        if exclusive and not service.reserve():
+            self.send_error(409, "a replication cycle is already running")
+            return
+        try:
+            self.stream(method, rpc(request))
+        finally:
+            if exclusive:
+                service.release()
+
+    def stream(self, method, messages):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.connected = True
+        try:
+            for message in messages:
+                self.write_line(json_format.MessageToDict(
+                    message, preserving_proto_field_name=True))
+        except Exception as err:
+            log.error("{} failed: {}".format(method, err))
+            self.write_line({"error": str(err)})
+        self.write_chunk(b"")
+
+    def write_line(self, data):
+        line = json.dumps(data, sort_keys=True).encode("utf-8") + b"\n"
+        self.write_chunk(line)
+
+    def write_chunk(self, data):
+        # a client going away does not cancel the cycle; its remaining output
+        # is dropped
+        if not self.connected:
+            return
+        try:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+        except OSError as err:
+            log.warning("client {} disconnected: {}".format(
+                self.address_string(), err))
+            self.connected = False
+
+    def log_message(self, format, *args):
+        log.info("%s - " + format, self.address_string(), *args)
+
+
+def make_server(service, host="0.0.0.0", port=50051):
+    """
+    Returns an HTTP server for `service`; each request is handled by its own
+    thread.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(service, host="0.0.0.0", port=50051):
+    """Serves `service` until interrupted."""
+    server = make_server(service, host=host, port=port)
+    log.info("serving the replicator API on http://{}:{}".format(
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
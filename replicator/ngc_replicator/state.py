@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import logging
+import os
+import re
+import threading
+
+import yaml
+
+from nvidia_deepops import utils
+
+log = utils.get_logger(__name__, level=logging.INFO)
+
+SCHEMA_VERSION = 1
+
+
+def docker_id_of(entry):
+    """
+    Returns the docker_id recorded for an image:tag in the replicator state.
+    Entries are dicts since OCI exports were added; older state files hold the
+    bare docker_id.
+    """
+    if isinstance(entry, dict):
+        return entry.get("docker_id")
+    return entry
+
+
+IMAGE_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+def content_digest(docker_id):
+    """
+    Returns `docker_id` if it is a content-addressed digest, i.e. a manifest
+    digest or a DGX `dockerImageId`, or None when it only identifies a version
+    of the tag, e.g. the NGC update date recorded with `--no-digests` or when a
+    digest could not be resolved.
+    """
+    if not isinstance(docker_id, str):
+        return None
+    if docker_id.startswith("sha256:") or IMAGE_ID.match(docker_id):
+        return docker_id
+    return None
+
+
+class LegacyStateLoader(yaml.SafeLoader):
+    """
+    Safe loader for the `state.yml` files of earlier releases, which dumped the
+    state as a `collections.defaultdict`.  Only its items are read; no Python
+    object is constructed from the file.
+    """
+
+    def construct_defaultdict(self, node):
+        for key, value in node.value:
+            if self.construct_object(key) == "dictitems":
+                return self.construct_mapping(value, deep=True)
+        return {}
+
+
+LegacyStateLoader.add_constructor(
+    "tag:yaml.org,2002:python/object/apply:collections.defaultdict",
+    LegacyStateLoader.construct_defaultdict)
+
+
+class StateStore:
+    """
+    Crash-safe store of the replicator state, i.e.
+    `image_name -> tag -> entry`.
+
+    Every image is committed on its own by appending one line to
+    `state.journal` and syncing it to disk.  The journal is periodically folded
+    into the `state.json` snapshot, which is replaced atomically, and then
+    truncated.  The state is read on first access by replaying the journal on
+    top of the snapshot.  A `state.yml` left by earlier releases is read in
+    place of a missing snapshot and migrated by the next compaction.
+
+    Tags are also indexed by the digest of the content they were cloned from,
+    see `tags_of`; entries without a digest are not indexed.  The snapshot also
+    keeps the registry catalog fingerprints of the last run in `catalog`.
+
+    :param str path: directory holding the snapshot and journal
+    :param int compact_every: number of commits between compactions
+    """
+
+    def __init__(self, path, compact_every=100):
+        self.snapshot_path = os.path.join(path, "state.json")
+        self.legacy_path = os.path.join(path, "state.yml")
+        self.journal_path = os.path.join(path, "state.journal")
+        self.compact_every = compact_every
+        self._state = None
+        self._catalog = None
+        self._by_id = collections.defaultdict(set)
+        self._commits = 0
+        self._lock = threading.RLock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state is None:
+                self.load()
+            return self._state
+
+    @property
+    def catalog(self):
+        with self._lock:
+            if self._state is None:
+                self.load()
+            return self._catalog
+
+    @catalog.setter
+    def catalog(self, catalog):
+        with self._lock:
+            self._catalog = catalog
+
+    def read_snapshot(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as file:
+                data = json.load(file)
+            if data.get("version", 0) > SCHEMA_VERSION:
+                raise RuntimeError(
+                    "{} was written by a newer replicator "
+                    "(schema version {})".format(
+                        self.snapshot_path, data["version"]))
+            return data
+        if os.path.exists(self.legacy_path):
+            log.info("migrating {} to {}".format(
+                self.legacy_path, self.snapshot_path))
+            with open(self.legacy_path, "r") as file:
+                return {"images": yaml.load(file, Loader=LegacyStateLoader)}
+        return {}
+
+    def load(self):
+        """Reads the snapshot, replays the journal and returns the state."""
+        with self._lock:
+            self._state = collections.defaultdict(dict)
+            data = self.read_snapshot()
+            for key, val in (data.get("images") or {}).items():
+                self._state[key] = val
+            if self._catalog is None:
+                self._catalog = data.get("catalog")
+            replayed = 0
+            truncated = False
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, "r") as file:
+                    for line in file:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # a commit interrupted mid-write; everything
+                            # before it is intact
+                            log.warning(
+                                "ignoring truncated record in {}".format(
+                                    self.journal_path))
+                            truncated = True
+                            break
+                        tags = self._state[record["name"]]
+                        tags[record["tag"]] = record["entry"]
+                        replayed += 1
+            self._by_id = collections.defaultdict(set)
+            for name, tags in self._state.items():
+                for tag, entry in tags.items():
+                    self._index(name, tag, entry)
+            self._commits = replayed
+            if replayed:
+                log.info("recovered {} images from {}".format(
+                    replayed, self.journal_path))
+            if truncated:
+                # later commits must not be appended to the partial record
+                self.compact()
+            return self._state
+
+    def commit(self, name, tag, entry):
+        """Records `entry` for `name:tag` durably before returning."""
+        record = json.dumps({"name": name, "tag": tag, "entry": entry},
+                            sort_keys=True)
+        with self._lock:
+            previous = self.state[name].get(tag)
+            if previous is not None:
+                digest = content_digest(docker_id_of(previous))
+                self._by_id.get(digest, set()).discard((name, tag))
+            self.state[name][tag] = entry
+            self._index(name, tag, entry)
+            with open(self.journal_path, "a") as file:
+                file.write(record + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self._commits += 1
+            if self._commits >= self.compact_every:
+                self.compact()
+
+    def _index(self, name, tag, entry):
+        digest = content_digest(docker_id_of(entry))
+        if digest:
+            self._by_id[digest].add((name, tag))
+
+    def tags_of(self, name, docker_id):
+        """
+        Returns the tags of image `name` already cloned from content
+        `docker_id`, which must be a digest; tags identified by anything else
+        never share content.
+        """
+        if not content_digest(docker_id):
+            return []
+        with self._lock:
+            if self._state is None:
+                self.load()
+            return sorted(tag for image_name, tag
+                          in self._by_id.get(docker_id, ())
+                          if image_name == name)
+
+    def copy(self):
+        """Returns a copy of the state that can be read while commits go on."""
+        with self._lock:
+            return {name: dict(tags)
+                    for name, tags in self.state.items() if tags}
+
+    def compact(self):
+        """
+        Atomically rewrites the snapshot from the state and empties the
+        journal.
+        """
+        with self._lock:
+            if self._state is None:
+                return
+            data = {
+                "version": SCHEMA_VERSION,
+                "images": {name: dict(tags)
+                           for name, tags in self._state.items() if tags},
+            }
+            if self._catalog:
+                data["catalog"] = self._catalog
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "w") as file:
+                json.dump(data, file, sort_keys=True, separators=(",", ":"))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.snapshot_path)
+            # replaying an old journal onto the new snapshot is harmless, so a
+            # crash before the truncation below loses nothing
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self._commits = 0
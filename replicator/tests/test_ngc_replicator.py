@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
 import os
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
 """Tests for `ngc_replicator` package."""
 
 import pytest
 
 from ngc_replicator import ngc_replicator
+from ngc_replicator.pipeline import Pipeline, Stage
+from ngc_replicator.service import ReplicatorService, make_server
+from ngc_replicator.state import StateStore
 
 try:
     from .secrets import ngcpassword, dgxpassword
@@ -36,9 +42,397 @@ def nvsa_replicator(*, output_path):
 @secrets
 def test_clone():
     with tempfile.TemporaryDirectory() as tmpdir:
-        state_file = os.path.join(tmpdir, "state.yml")
+        state_file = os.path.join(tmpdir, "state.json")
         assert not os.path.exists(state_file)
         replicator = nvsa_replicator(output_path=tmpdir)
         replicator.sync()
         assert os.path.exists(state_file)
         assert 'nvsa_clone/busybox' in replicator.state
+
+
+class FakeDockerClient:
+
+    def __init__(self):
+        self.calls = []
+
+    def pull(self, url, progress=None):
+        self.calls.append(("pull", url))
+
+    def save(self, url, path=None, progress=None):
+        self.calls.append(("save", url))
+
+    def tag(self, src_url, dst_url):
+        self.calls.append(("tag", dst_url))
+
+    def push(self, url):
+        self.calls.append(("push", url))
+
+    def get(self, *, url):
+        return True
+
+    def image_size(self, url):
+        return None
+
+    def remove(self, url):
+        self.calls.append(("remove", url))
+
+
+class FakeTargetRegistry:
+
+    def __init__(self):
+        self.manifests = {}
+
+    def get_raw_manifest(self, name, reference):
+        return self.manifests[(name, reference)], "application/json", None
+
+    def put_manifest(self, name, reference, content, media_type):
+        self.manifests[(name, reference)] = content
+
+
+def fake_replicator(tmpdir, monkeypatch):
+    replicator = ngc_replicator.Replicator.__new__(ngc_replicator.Replicator)
+    replicator._config = {"registry_url": "registry.local"}
+    replicator.output_path = tmpdir
+    replicator.state_store = StateStore(tmpdir)
+    replicator.progress = ngc_replicator.Progress()
+    replicator.progress.add_step(key="busybox:latest")
+    replicator.nvcr_client = FakeDockerClient()
+    replicator.registry_client = FakeDockerClient()
+    replicator.target_registry = FakeTargetRegistry()
+    replicator.registry_url = "registry.local"
+    replicator.oci_copier = replicator.copier = None
+    replicator.export_to_tarfile = replicator.export_to_singularity = True
+    monkeypatch.setattr(ngc_replicator.utils, "execute",
+                        lambda command: replicator.nvcr_client.calls.append(("singularity", command)))
+    return replicator
+
+
+def test_clone_image_pulls_once(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        replicator = fake_replicator(tmpdir, monkeypatch)
+        entry = replicator.clone_image("busybox", "latest", "")
+        assert entry == {"docker_id": ""}
+        calls = [call[0] for call in replicator.nvcr_client.calls]
+        assert calls[0] == "pull" and calls.count("pull") == 1
+        assert calls[-1] == "remove"
+        assert sorted(calls[1:-1]) == ["save", "singularity"]
+        assert ("push", "registry.local/busybox:latest") in replicator.registry_client.calls
+
+
+def test_clone_image_retags_known_content(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        replicator = fake_replicator(tmpdir, monkeypatch)
+        known = ngc_replicator.replicator_pb2.DockerImage(name="busybox", tag="1.31", docker_id="")
+        for path in (replicator.tarfile_path(known), replicator.sif_path(known)):
+            with open(path, "w") as file:
+                file.write("image")
+        with open(replicator.tarfile_path(known) + ".sha256", "w") as file:
+            file.write("abc  {}\n".format(os.path.basename(replicator.tarfile_path(known))))
+        replicator.target_registry.manifests[("busybox", "1.31")] = b"{}"
+        replicator.state_store.commit("busybox", "1.31", {"docker_id": "sha256:abc"})
+        replicator.image_url = lambda image: "{}:{}".format(image.name, image.tag)
+
+        entry = replicator.clone_image("busybox", "latest", "sha256:abc")
+        assert entry == {"docker_id": "sha256:abc"}
+        assert replicator.nvcr_client.calls == []
+        image = ngc_replicator.replicator_pb2.DockerImage(name="busybox", tag="latest")
+        assert os.path.samefile(replicator.tarfile_path(known), replicator.tarfile_path(image))
+        assert os.path.samefile(replicator.sif_path(known), replicator.sif_path(image))
+        with open(replicator.tarfile_path(image) + ".sha256") as file:
+            assert file.read().split()[1] == os.path.basename(replicator.tarfile_path(image))
+        assert replicator.target_registry.manifests[("busybox", "latest")] == b"{}"
+
+        # without the registry manifest the image is cloned in full
+        del replicator.target_registry.manifests[("busybox", "latest")]
+        del replicator.target_registry.manifests[("busybox", "1.31")]
+        replicator.clone_image("busybox", "latest", "sha256:abc")
+        assert replicator.nvcr_client.calls[0] == ("pull", "busybox:latest")
+
+
+def test_tarfile_path_without_docker():
+    replicator = ngc_replicator.Replicator.__new__(ngc_replicator.Replicator)
+    replicator._config = {"export_compression": "zstd"}
+    replicator.output_path = "/export"
+    replicator.image_url = lambda image: "nvcr.io/{}:{}".format(image.name, image.tag)
+    image = ngc_replicator.replicator_pb2.DockerImage(name="nvidia/cuda", tag="10.0")
+    assert replicator.tarfile_path(image) == "/export/docker_image_nvcr.io%%nvidia%%cuda:10.0.tar.zst"
+    assert "nvcr_client" not in vars(replicator)
+
+
+def test_clone_image_does_not_retag_by_date(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        replicator = fake_replicator(tmpdir, monkeypatch)
+        replicator.image_url = lambda image: "{}:{}".format(image.name, image.tag)
+        # 1.31 (sha256:a) and latest (sha256:b) were updated at the same time; without
+        # digests both are identified by that date
+        updated = "2017-12-04T05:56:41Z"
+        known = ngc_replicator.replicator_pb2.DockerImage(name="busybox", tag="1.31", docker_id=updated)
+        for path in (replicator.tarfile_path(known), replicator.sif_path(known)):
+            with open(path, "w") as file:
+                file.write("image")
+        replicator.target_registry.manifests[("busybox", "1.31")] = b"{}"
+        replicator.state_store.commit("busybox", "1.31", {"docker_id": updated})
+        assert replicator.state_store.tags_of("busybox", updated) == []
+
+        replicator.clone_image("busybox", "latest", updated)
+        assert replicator.nvcr_client.calls[0] == ("pull", "busybox:latest")
+        assert ("busybox", "latest") not in replicator.target_registry.manifests
+
+
+def test_clone_images_commits_finished_images(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        replicator = fake_replicator(tmpdir, monkeypatch)
+        replicator._config["pull_workers"] = 3
+        replicator.image_url = lambda image: "{}:{}".format(image.name, image.tag)
+        pull = replicator.nvcr_client.pull
+
+        def slow_failing_pull(url, progress=None):
+            if url == "busybox:1.0":
+                time.sleep(0.2)
+                raise RuntimeError("pull failed")
+            pull(url)
+        replicator.nvcr_client.pull = slow_failing_pull
+        images = [ngc_replicator.replicator_pb2.DockerImage(name="busybox", tag=tag, docker_id="sha256:" + tag)
+                  for tag in ("1.0", "1.1", "1.2")]
+        for image in images:
+            replicator.progress.add_step(key="busybox:" + image.tag)
+        with pytest.raises(RuntimeError):
+            list(replicator.clone_images(images))
+        # the images that finished behind the failed one are not lost
+        assert replicator.state_store.state["busybox"] == {
+            "1.1": {"docker_id": "sha256:1.1"}, "1.2": {"docker_id": "sha256:1.2"}}
+
+
+def test_dry_run_is_lazy():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        replicator = ngc_replicator.Replicator(api_key="api-key", project="nvidia", output_path=tmpdir,
+                                               exporter=True, singularity=True,
+                                               registry_url="registry.local", dry_run=True)
+        image = ngc_replicator.replicator_pb2.DockerImage(name="nvidia/cuda", tag="10.0", docker_id="abc")
+        replicator.images_to_download = lambda project=None, catalog=None, names=None: iter([image])
+        assert list(replicator.sync_images()) == []
+        for name in ("nvcr", "nvcr_client", "registry_client", "target_registry"):
+            assert name not in vars(replicator)
+
+
+class StubReplicator:
+
+    def __init__(self, tmpdir):
+        self.project = "nvidia"
+        self.min_version = None
+        self.images = []
+        self.progress = ngc_replicator.Progress()
+        self.state_store = StateStore(tmpdir)
+        self.cycles = []
+
+    def config(self, key, default=None):
+        return default
+
+    def replicate(self, project=None):
+        self.cycles.append((project, self.min_version, self.images))
+        for tag in ("1.0", "2.0"):
+            self.state_store.commit(project + "/cuda", tag, {"docker_id": "sha256:" + tag})
+            yield ngc_replicator.replicator_pb2.DockerImage(name=project + "/cuda", tag=tag,
+                                                            docker_id="sha256:" + tag)
+
+
+def test_service_streams_images():
+    from urllib.request import urlopen
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        replicator = StubReplicator(tmpdir)
+        replicator.state_store.commit("hpc/namd", "2.13", "legacy-id")
+        server = make_server(ReplicatorService(replicator=replicator), host="127.0.0.1", port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/Replicator/".format(server.server_address[1])
+        try:
+            body = json.dumps({"org_name": "hpc", "min_version": "19.10"}).encode()
+            with urlopen(url + "StartReplication", data=body) as response:
+                lines = [json.loads(line) for line in response]
+            assert lines == [{"name": "hpc/cuda", "tag": "1.0", "docker_id": "sha256:1.0"},
+                             {"name": "hpc/cuda", "tag": "2.0", "docker_id": "sha256:2.0"}]
+            # request filters apply to their own cycle only
+            assert replicator.cycles == [("hpc", "19.10", [])]
+            assert replicator.min_version is None
+
+            with urlopen(url + "DownloadedImages", data=json.dumps({"org_name": "hpc"}).encode()) as response:
+                lines = [json.loads(line) for line in response]
+            assert [(line["tag"], line["docker_id"]) for line in lines] == \
+                [("1.0", "sha256:1.0"), ("2.0", "sha256:2.0"), ("2.13", "legacy-id")]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_service_rejects_concurrent_cycles():
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        replicator = StubReplicator(tmpdir)
+        service = ReplicatorService(replicator=replicator)
+        server = make_server(service, host="127.0.0.1", port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/Replicator/".format(server.server_address[1])
+        try:
+            assert service.reserve()
+            for method in ("StartReplication", "ListImages"):
+                with pytest.raises(HTTPError) as err:
+                    urlopen(url + method, data=b"{}")
+                assert err.value.code == 409
+            with urlopen(url + "DownloadedImages", data=b"{}") as response:
+                assert response.status == 200
+            assert replicator.cycles == []
+            service.release()
+
+            with urlopen(url + "StartReplication", data=b"{}") as response:
+                assert len(response.readlines()) == 2
+            # the handler gives the cycle back once its stream has ended
+            deadline = time.monotonic() + 5
+            while not service.reserve():
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            service.release()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_watch_polls_changed_repositories(monkeypatch):
+    interval = ngc_replicator.PollInterval(60, 300, jitter=0)
+    assert [interval.next(changed) for changed in (False, False, False, True)] == [120, 240, 300, 60]
+
+    replicator = ngc_replicator.Replicator.__new__(ngc_replicator.Replicator)
+    replicator._config = {}
+    replicator.project = "nvidia"
+    replicator.images = []
+    replicator.progress = ngc_replicator.Progress()
+    changes = [{"nvidia/cuda"}, set(), {"nvidia/pytorch"}]
+
+    class Catalog:
+        def changed(self, project=None):
+            return changes.pop(0)
+
+    cycles = []
+    delays = []
+
+    def replicate(project=None, catalog=None, names=None):
+        cycles.append(names)
+        return iter([])
+
+    def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 4:
+            raise KeyboardInterrupt
+
+    replicator.snapshot = Catalog
+    replicator.replicate = replicate
+    monkeypatch.setattr(ngc_replicator.time, "sleep", sleep)
+    replicator.watch()
+    # a complete cycle first, then only the repositories that changed since
+    assert cycles == [None, {"nvidia/cuda"}, {"nvidia/pytorch"}]
+    assert delays[1] < 70 < delays[2] and delays[3] < 70
+
+
+def test_watch_runs_complete_cycles_without_fingerprints(monkeypatch):
+    replicator = ngc_replicator.Replicator.__new__(ngc_replicator.Replicator)
+    replicator._config = {"watch_max_interval": 300}
+    replicator.project = "nvidia"
+    replicator.images = []
+    replicator.progress = ngc_replicator.Progress()
+
+    class Catalog:
+        # a DGX catalog: repositories without fingerprints never look changed
+        def changed(self, project=None):
+            return set()
+
+    clock = [0.0]
+    cycles = []
+
+    def replicate(project=None, catalog=None, names=None):
+        cycles.append((clock[0], names))
+        return iter([])
+
+    def sleep(delay):
+        clock[0] += delay
+        if clock[0] > 1000:
+            raise KeyboardInterrupt
+
+    replicator.snapshot = Catalog
+    replicator.replicate = replicate
+    monkeypatch.setattr(ngc_replicator.random, "uniform", lambda a, b: 1)
+    monkeypatch.setattr(ngc_replicator.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(ngc_replicator.time, "sleep", sleep)
+    replicator.watch()
+    # polls at 0, 60, 180, 420, 480, 600, 840 and 900; a complete cycle once 300 sec have passed
+    assert cycles == [(0, None), (420, None), (840, None)]
+
+
+def test_pipeline_order_and_errors():
+    released = []
+    overlap = threading.Event()
+    active = set()
+    lock = threading.Lock()
+
+    def track(stage, item):
+        with lock:
+            active.add(stage)
+            if len(active) > 1:
+                overlap.set()
+        time.sleep(0.01 * (5 - item))
+        with lock:
+            active.discard(stage)
+
+    def pull(item):
+        track("pull", item)
+        if item == 3:
+            raise RuntimeError("pull failed")
+        return item * 10
+
+    def export(item):
+        track("export", item)
+
+    steps = [Stage("pull", pull, workers=2),
+             [Stage("export", export)],
+             Stage("remove", released.append, always=True)]
+    jobs = list(Pipeline(steps).run(iter(range(5))))
+    assert [job.item for job in jobs] == list(range(5))
+    assert [job.results.get("pull") for job in jobs] == [0, 10, 20, None, 40]
+    assert isinstance(jobs[3].error, RuntimeError)
+    assert "export" not in jobs[3].results
+    assert sorted(released) == list(range(5))
+    assert overlap.is_set()
+
+
+def test_state_store_recovers_commits():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "state.yml"), "w") as file:
+            file.write("!!python/object/apply:collections.defaultdict\n"
+                       "args:\n- !!python/name:builtins.dict ''\n"
+                       "dictitems:\n  nvidia/cuda:\n    '10.0': abc\n")
+        store = StateStore(tmpdir, compact_every=3)
+        assert store.load()["nvidia/cuda"] == {"10.0": "abc"}
+        store.commit("nvidia/pytorch", "20.03", {"docker_id": "def"})
+        store.commit("nvidia/pytorch", "20.04", {"docker_id": "ghi"})
+        # a crash while appending leaves a partial record behind
+        with open(store.journal_path, "a") as file:
+            file.write('{"name": "nvidia/pyt')
+
+        state = StateStore(tmpdir).load()
+        assert state["nvidia/cuda"] == {"10.0": "abc"}
+        assert state["nvidia/pytorch"] == {"20.03": {"docker_id": "def"},
+                                           "20.04": {"docker_id": "ghi"}}
+
+        store = StateStore(tmpdir, compact_every=2)
+        store.load()
+        store.commit("nvidia/tensorflow", "20.03", {"docker_id": "jkl"})
+        assert StateStore(tmpdir).load()["nvidia/tensorflow"] == {"20.03": {"docker_id": "jkl"}}
+        store.commit("nvidia/tensorflow", "20.04", {"docker_id": "mno"})
+        assert not os.path.exists(store.journal_path)
+        assert len(StateStore(tmpdir).load()["nvidia/tensorflow"]) == 2
+        with open(store.snapshot_path) as file:
+            assert json.load(file)["version"] == 1
+
+        store.catalog = {"nvidia/pytorch": {"fingerprint": "latestTag=20.04"}}
+        store.compact()
+        assert StateStore(tmpdir).catalog == store.catalog